@@ -0,0 +1,256 @@
+import os
+import numpy as np
+import time as timer
+from my_simulator import numpy_circuit
+from my_circuit_blueprint import qml, num_feat, num_params
+from my_qml import reset_spsa, reset_lazy, get_lazy_counts, flush_lazy, gradient_pool, make_weights, make_features, quantum_gradient, calc_expectations, reset_execution_counts, get_execution_counts
+from my_training import optimize_model, fused_optimize_step, train_step, batch_bounds, data_parallel_epoch, quick_train_model
+from my_metrics import metrics_test
+
+def time_call(func, *args, n_repeats = 5):
+  # Returns the best wall-clock time of n_repeats calls in seconds
+  times = [0]*n_repeats
+  for i in range(n_repeats):
+    start_time = timer.time()
+    func(*args)
+    times[i] = timer.time() - start_time
+  return min(times)
+
+def make_ansatz(num_wires, depth):
+  # Builds a re-uploading RX/CZ ansatz in the blueprint style with num_wires*depth parameters
+  dev = qml.device('default.qubit', wires = num_wires)
+
+  @qml.qnode(dev)
+  def ansatz(features, params):
+    for layer in range(depth):
+      for wire in range(num_wires):
+        qml.RX(features[wire], wires = wire)
+      qml.broadcast(qml.CZ, wires = list(range(num_wires)), pattern = "ring")
+      for wire in range(num_wires):
+        qml.RX(params[layer*num_wires + wire], wires = wire)
+    return qml.expval(qml.PauliZ(0))
+
+  return numpy_circuit(ansatz, num_wires, num_wires*depth)
+
+def shift_rule_gradient(circ_func, features, params):
+  # Parameter-shift rule on a single sub-circuit, two evaluations per parameter
+  gradients = np.zeros(len(params))
+  for i in range(len(params)):
+    shift = np.zeros(len(params))
+    shift[i] = np.pi/2
+    gradients[i] = 0.5*(circ_func(features, params + shift) - circ_func(features, params - shift))
+  return gradients
+
+def adjoint_sweep_gradient(circ_func, features, params):
+  # Adjoint gradient on a single sub-circuit, one forward and one backward sweep
+  return circ_func.adjoint(features, params)[2]
+
+def benchmark_gradients(num_wires = 3, depths = [1, 2, 4, 8, 16, 32], n_repeats = 5):
+  # Times the shift rule against the adjoint sweep as the number of parameters grows
+  print("Gradient benchmark, parameter-shift against adjoint on the numpy engine:")
+  print(f"{'num_params':>12}{'shift (ms)':>14}{'adjoint (ms)':>16}{'speedup':>10}")
+  for depth in depths:
+    circ_func = make_ansatz(num_wires, depth)
+    features = np.pi*np.random.random(num_wires)
+    params = 2*np.pi*np.random.random(num_wires*depth)
+    shift_time = time_call(shift_rule_gradient, circ_func, features, params, n_repeats = n_repeats)
+    adjoint_time = time_call(adjoint_sweep_gradient, circ_func, features, params, n_repeats = n_repeats)
+    print(f"{num_wires*depth:>12}{1000*shift_time:>14.3f}{1000*adjoint_time:>16.3f}{shift_time/adjoint_time:>10.1f}")
+
+  features, params = np.array(make_features()), make_weights(1)[0]
+  print(f"Blueprint ({num_params} params):")
+  for method in ['parameter-shift', 'adjoint']:
+    print(f"{method:>16}: {1000*time_call(quantum_gradient, features, params, method, n_repeats = n_repeats):.3f} ms")
+
+def count_step_executions(n_circuits = 3, n_samples = 20):
+  # Circuit executions per training sample, optimize_model followed by a separate calc_expectations against the fused step
+  features = [np.array(make_features()) for _ in range(n_samples)]
+  targets = np.random.randint(n_circuits, size = n_samples)
+  weights = make_weights(n_circuits)
+
+  reset_execution_counts()
+  separate_weights = [np.array(w) for w in weights]
+  for x, y in zip(features, targets):
+    separate_weights, _ = optimize_model(x, y, separate_weights, n_circuits)
+    calc_expectations(x, separate_weights, n_circuits)
+  separate = get_execution_counts()
+
+  reset_execution_counts()
+  fused_weights = [np.array(w) for w in weights]
+  for x, y in zip(features, targets):
+    fused_weights, _, _ = fused_optimize_step(x, y, fused_weights, n_circuits)
+  fused = get_execution_counts()
+
+  print(f"Executions per sample with {n_circuits} circuits:")
+  for name, counts in [('separate', separate), ('fused', fused)]:
+    print(f"{name:>16}: {counts['executions']/n_samples:.1f} executions in {counts['dispatches']/n_samples:.1f} dispatches")
+
+def train_epoch(X_train, Y_train, weights, n_circuits, batch_size):
+  # One epoch of optimization steps without any evaluation or recording
+  for start, stop in batch_bounds(len(X_train), batch_size):
+    weights, _, _ = train_step(X_train[start:stop], Y_train[start:stop], weights, n_circuits, post_expectations = False)
+  return weights
+
+def benchmark_batch_sizes(n_circuits = 3, n_samples = 256, batch_sizes = [1, 4, 16, 64]):
+  # Training throughput of one epoch as the mini-batch grows
+  X_train = np.pi*np.random.random([n_samples, num_feat])
+  Y_train = np.random.randint(n_circuits, size = n_samples)
+  weights = make_weights(n_circuits)
+
+  print(f"Mini-batch throughput with {n_circuits} circuits:")
+  print(f"{'batch_size':>12}{'samples/s':>14}")
+  for batch_size in batch_sizes:
+    train_time = time_call(train_epoch, X_train, Y_train, [np.array(w) for w in weights], n_circuits, batch_size, n_repeats = 1)
+    print(f"{batch_size:>12}{n_samples/train_time:>14.1f}")
+
+def benchmark_data_parallel(n_circuits = 3, n_samples = 512, batch_size = 8, worker_counts = None):
+  # Throughput of one synchronous data-parallel epoch from 1 worker up to every core, the pools are started before the clock runs
+  worker_counts = worker_counts if worker_counts else sorted({1, *[2**i for i in range(1, 8) if 2**i < os.cpu_count()], os.cpu_count()})
+  X_train = np.pi*np.random.random([n_samples, num_feat])
+  Y_train = np.random.randint(n_circuits, size = n_samples)
+  weights = make_weights(n_circuits)
+
+  print(f"Data-parallel throughput with {n_circuits} circuits and {batch_size} samples per worker per step ({os.cpu_count()} cores):")
+  print(f"{'n_workers':>12}{'samples/s':>14}{f'vs {worker_counts[0]} workers':>16}")
+  base_time = None # Time of worker_counts[0], the speedups are relative to it
+  for n_workers in worker_counts:
+    with gradient_pool(n_workers):
+      train_time = time_call(data_parallel_epoch, X_train, Y_train, [np.array(w) for w in weights], n_circuits, 0.1, batch_size, n_workers, n_repeats = 1)
+    base_time = base_time if base_time else train_time
+    print(f"{n_workers:>12}{n_samples/train_time:>14.1f}{base_time/train_time:>16.2f}")
+
+def make_benchmark_data(n_circuits = 3, n_samples = 512, test_frac = 0.25):
+  # Synthetic data set whose class is set by the first feature, as a (X_train, X_test, Y_train, Y_test) tuple
+  X = np.pi*np.random.random([n_samples, num_feat])
+  Y = np.minimum((n_circuits*X[:, 0]/np.pi).astype(int), n_circuits -1)
+  n_test = int(n_samples*test_frac)
+  return X[n_test:], X[:n_test], Y[n_test:], Y[:n_test]
+
+def compare_hogwild(data_tuple = None, n_circuits = 3, n_workers = None, n_epochs = 1, alpha = 0.1):
+  # Trains the sequential baseline and the lock-free asynchronous mode from the same weights, reports time, accuracy & staleness
+  n_workers = n_workers if n_workers else os.cpu_count()
+  data_tuple = data_tuple if data_tuple else make_benchmark_data(n_circuits)
+  X_train, X_test, Y_train, Y_test = data_tuple
+  weights = make_weights(n_circuits)
+
+  print(f"Sequential against Hogwild training with {n_workers} workers over {len(X_train)} samples ({os.cpu_count()} cores):")
+  for name, n_procs in [('sequential', 1), ('hogwild', n_workers)]:
+    report = {}
+    with gradient_pool(n_procs):
+      start_time = timer.time()
+      trained = quick_train_model(data_tuple, n_circuits, [np.array(w) for w in weights], alpha = alpha, n_epochs = n_epochs, display = False,
+                                  n_workers = n_procs, parallel_mode = 'hogwild', report = report)
+      train_time = timer.time() - start_time
+    accuracy = metrics_test(trained, X_test, Y_test, n_circuits)['model_accuracy']
+    print(f"{name:>16}: {train_time:.2f} s, accuracy {accuracy:.3f}")
+    print(f"{'staleness':>16}: {report['staleness']}") if 'staleness' in report else None
+
+def time_to_accuracy(data_tuple, n_circuits, weights, method, target_accuracy, alpha = 0.1, max_epochs = 5, eval_every = 25, optimizer = 'gradient',
+                     batch_size = 1):
+  # Trains with one gradient method or optimizer, returns the training time (evaluations excluded) until the test accuracy reaches target_accuracy
+  # along with the executions per step, the best accuracy seen and the total training executions, the time is None if the target is never reached
+  X_train, X_test, Y_train, Y_test = data_tuple
+  reset_spsa()
+  reset_execution_counts()
+  train_time, steps, eval_executions, best_accuracy = 0.0, 0, 0, 0.0
+  train_executions = lambda: get_execution_counts()['executions'] - eval_executions
+  for n in range(max_epochs):
+    for start, stop in batch_bounds(len(X_train), batch_size):
+      start_time = timer.time()
+      weights, _, _ = train_step(X_train[start:stop], Y_train[start:stop], weights, n_circuits, alpha = alpha, post_expectations = False,
+                                 method = method, optimizer = optimizer)
+      train_time, steps = train_time + timer.time() - start_time, steps +1
+      if steps % eval_every == 0:
+        executions = get_execution_counts()['executions']
+        best_accuracy = max(best_accuracy, metrics_test(weights, X_test, Y_test, n_circuits)['model_accuracy'])
+        eval_executions += get_execution_counts()['executions'] - executions # Evaluations don't count towards the training executions
+        if best_accuracy >= target_accuracy:
+          return train_time, train_executions()/steps, best_accuracy, train_executions()
+  return None, train_executions()/steps, best_accuracy, train_executions()
+
+def benchmark_time_to_accuracy(data_tuple = None, n_circuits = 3, target_accuracy = 0.8, methods = ['parameter-shift', 'spsa'], alpha = 0.1, max_epochs = 5):
+  # Compares the training time gradient methods need to reach the same test accuracy from the same weights
+  data_tuple = data_tuple if data_tuple else make_benchmark_data(n_circuits)
+  weights = make_weights(n_circuits)
+
+  print(f"Time to {target_accuracy:.0%} test accuracy ({num_params} params, {n_circuits} circuits):")
+  print(f"{'method':>16}{'time (s)':>12}{'executions/step':>18}{'best accuracy':>16}")
+  for method in methods:
+    train_time, step_executions, best_accuracy, _ = time_to_accuracy(data_tuple, n_circuits, [np.array(w) for w in weights], method, target_accuracy,
+                                                                     alpha = alpha, max_epochs = max_epochs)
+    time_text = f"{train_time:.2f}" if train_time is not None else "not reached"
+    print(f"{method:>16}{time_text:>12}{step_executions:>18.1f}{best_accuracy:>16.3f}")
+
+def benchmark_rotosolve(data_tuple = None, n_circuits = 3, target_accuracy = 0.8, batch_sizes = [1, 10], alpha = 0.1, max_epochs = 3, eval_every = 5):
+  # Compares the circuit executions the shift-rule gradient step and Rotosolve sweeps need to reach the same test accuracy from the same weights
+  data_tuple = data_tuple if data_tuple else make_benchmark_data(n_circuits)
+  weights = make_weights(n_circuits)
+
+  print(f"Executions to {target_accuracy:.0%} test accuracy ({num_params} params, {n_circuits} circuits):")
+  print(f"{'optimizer':>12}{'batch':>8}{'executions':>12}{'executions/step':>18}{'time (s)':>12}{'best accuracy':>16}")
+  for optimizer in ['gradient', 'rotosolve']:
+    for batch_size in batch_sizes:
+      train_time, step_executions, best_accuracy, executions = time_to_accuracy(data_tuple, n_circuits, [np.array(w) for w in weights],
+                                                                                'parameter-shift', target_accuracy, alpha = alpha,
+                                                                                max_epochs = max_epochs, eval_every = eval_every,
+                                                                                optimizer = optimizer, batch_size = batch_size)
+      executions_text, time_text = (f"{executions}", f"{train_time:.2f}") if train_time is not None else ("not reached", "-")
+      print(f"{optimizer:>12}{batch_size:>8}{executions_text:>12}{step_executions:>18.1f}{time_text:>12}{best_accuracy:>16.3f}")
+
+def compare_lazy_deoptimization(data_tuple = None, n_circuits = 3, beta_tols = [0.005, 0.01, 0.02], alpha = 0.1, n_epochs = 2):
+  # Trains sample by sample from the same weights with exact de-optimization and with every beta_tol in both lazy modes, reports the circuit
+  # executions & dispatches of training, the de-optimize gradients skipped or deferred and the test accuracy against the exact mode
+  data_tuple = data_tuple if data_tuple else make_benchmark_data(n_circuits)
+  X_train, X_test, Y_train, Y_test = data_tuple
+  weights = make_weights(n_circuits)
+
+  print(f"Lazy de-optimization against the exact step over {n_epochs} epochs of {len(X_train)} samples (alpha = {alpha}):")
+  print(f"{'mode':>8}{'beta_tol':>10}{'executions':>12}{'dispatches':>12}{'computed':>10}{'skipped':>9}{'deferred':>10}{'accuracy':>10}{'gap':>8}")
+  exact_accuracy = None
+  for lazy_mode, beta_tol in [('exact', None)] + [(lazy_mode, beta_tol) for lazy_mode in ['defer', 'skip'] for beta_tol in beta_tols]:
+    trained = [np.array(w) for w in weights]
+    reset_lazy()
+    reset_execution_counts()
+    for n in range(n_epochs):
+      for i in range(len(X_train)):
+        trained, _ = optimize_model(X_train[i], Y_train[i], trained, n_circuits, alpha = alpha, beta_tol = beta_tol, lazy_mode = lazy_mode)
+      trained = flush_lazy(trained, alpha = alpha)
+    counts, lazy_counts = get_execution_counts(), get_lazy_counts()
+    accuracy = metrics_test(trained, X_test, Y_test, n_circuits)['model_accuracy']
+    exact_accuracy = accuracy if exact_accuracy is None else exact_accuracy
+    computed = lazy_counts['computed'] if beta_tol is not None else len(X_train)*n_epochs*(n_circuits -1)
+    print(f"{lazy_mode:>8}{str(beta_tol):>10}{counts['executions']:>12}{counts['dispatches']:>12}{computed:>10}{lazy_counts['skipped']:>9}"
+          f"{lazy_counts['deferred']:>10}{accuracy:>10.3f}{accuracy - exact_accuracy:>8.3f}")
+
+def benchmark_concurrent_circuits(circuit_counts = [2, 3, 4, 6], methods = ['parameter-shift', 'adjoint'], n_samples = 30, alpha = 0.1):
+  # Times the circuit-by-circuit optimize step against the concurrent one, from the same weights over the same samples,
+  # with the largest weight difference between the two after every sample's step
+  features = [np.array(make_features()) for _ in range(n_samples)]
+
+  print(f"Optimize step per sample, circuit by circuit against concurrent ({num_params} params):")
+  print(f"{'method':>16}{'circuits':>10}{'sequential (ms)':>18}{'concurrent (ms)':>18}{'speedup':>10}{'max weight diff':>18}")
+  for method in methods:
+    for n_circuits in circuit_counts:
+      targets = np.random.randint(n_circuits, size = n_samples)
+      weights = make_weights(n_circuits)
+      results = {}
+      for concurrent_circuits in [False, True]:
+        trained = [np.array(w) for w in weights]
+        start_time = timer.time()
+        for x, y in zip(features, targets):
+          trained, _ = optimize_model(x, y, trained, n_circuits, alpha = alpha, method = method, concurrent_circuits = concurrent_circuits)
+        results[concurrent_circuits] = (1000*(timer.time() - start_time)/n_samples, trained)
+      (sequential_time, sequential_weights), (concurrent_time, concurrent_weights) = results[False], results[True]
+      difference = max(np.max(np.abs(a - b)) for a, b in zip(sequential_weights, concurrent_weights))
+      print(f"{method:>16}{n_circuits:>10}{sequential_time:>18.2f}{concurrent_time:>18.2f}{sequential_time/concurrent_time:>10.2f}{difference:>18.2e}")
+
+if __name__ == '__main__':
+  benchmark_gradients()
+  count_step_executions()
+  benchmark_batch_sizes()
+  benchmark_data_parallel()
+  compare_hogwild()
+  benchmark_time_to_accuracy()
+  benchmark_rotosolve()
+  compare_lazy_deoptimization()
+  benchmark_concurrent_circuits()
@@ -0,0 +1,121 @@
+import sys
+import numpy as np
+import time as timer
+from collections import OrderedDict
+
+def entry_bytes(key, value):
+  # Memory held by a cache entry, arrays count their buffers and tuples or lists their items
+  if isinstance(value, np.ndarray):
+    value_bytes = value.nbytes
+  elif isinstance(value, (tuple, list)):
+    value_bytes = sum(entry_bytes(None, item) for item in value)
+  else:
+    value_bytes = sys.getsizeof(value)
+  return value_bytes + (len(key) if isinstance(key, bytes) else 0)
+
+class lru_cache:
+  def __init__(self, max_entries, ttl = None, max_bytes = None):
+    # Bounded mapping that evicts the least recently used entry once it holds max_entries, counts its hits & misses
+    # With a ttl entries expire that many seconds after they were stored, with max_bytes the entries' memory (see entry_bytes) is bounded too
+    self.max_entries = max_entries
+    self.ttl, self.max_bytes = ttl, max_bytes
+    self.entries = OrderedDict()
+    self.stored_times = {}
+    self.sizes = {}
+    self.bytes = 0
+    self.hits, self.misses, self.evictions, self.expirations = 0, 0, 0, 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, key, default = None):
+    # Returns the cached value and marks it as most recently used, default on a miss or once the entry has expired
+    if key in self.entries:
+      if self.ttl is not None and timer.monotonic() - self.stored_times[key] > self.ttl:
+        self.remove(key)
+        self.expirations += 1
+      else:
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+    self.misses += 1
+    return default
+
+  def put(self, key, value):
+    # Stores a value, evicting least recently used entries to stay within max_entries (and max_bytes)
+    if self.max_bytes is not None:
+      self.remove(key) if key in self.entries else None
+      self.sizes[key] = entry_bytes(key, value)
+      self.bytes += self.sizes[key]
+    if self.ttl is not None:
+      self.stored_times[key] = timer.monotonic()
+    self.entries[key] = value
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes and self.entries):
+      self.remove(next(iter(self.entries)))
+      self.evictions += 1
+
+  def remove(self, key):
+    # Drops one entry
+    del self.entries[key]
+    self.stored_times.pop(key, None)
+    self.bytes -= self.sizes.pop(key, 0)
+
+  def clear(self):
+    # Drops every entry, the counters are kept
+    self.entries.clear()
+    self.stored_times.clear()
+    self.sizes.clear()
+    self.bytes = 0
+
+  def stats(self):
+    # Returns the hit & miss counters along with the hit rate and the number of entries held
+    lookups = self.hits + self.misses
+    return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations, 'entries': len(self.entries),
+            'bytes': self.bytes, 'hit_rate': self.hits/lookups if lookups else 0.0}
+
+
+class prediction_cache:
+  def __init__(self, max_entries = 4096, ttl = None, max_bytes = None, tolerance = None):
+    # Expectations of every circuit keyed by the features they were computed for, valid for one set of weights
+    # With a tolerance the features are rounded to multiples of it first, so features within the same tolerance cell share an entry
+    self.cache = lru_cache(max_entries, ttl = ttl, max_bytes = max_bytes)
+    self.tolerance = tolerance
+    self.weights_key = None
+    self.invalidations = 0
+
+  def key(self, features):
+    features = np.asarray(features, dtype = float)
+    if self.tolerance:
+      return np.round(features/self.tolerance).astype(np.int64).tobytes()
+    return features.tobytes()
+
+  def check_weights(self, weights):
+    # Drops every entry once the weights differ from the ones the entries were computed with, whether they were replaced or changed in place
+    weights_key = b''.join(np.asarray(circuit_weights, dtype = float).tobytes() for circuit_weights in weights)
+    if weights_key != self.weights_key:
+      self.invalidations += 1 if self.weights_key is not None else 0
+      self.cache.clear()
+      self.weights_key = weights_key
+
+  def expectations_all(self, all_features, weights, calc_all):
+    # Expectations of every feature row, the distinct rows missing from the cache are computed together with calc_all(rows) and stored
+    self.check_weights(weights)
+    keys = [self.key(features) for features in all_features]
+    found = [self.cache.get(key) for key in keys]
+    missing = {} # First row of every missing key, repeated rows are only computed once
+    for i, expectations in enumerate(found):
+      missing.setdefault(keys[i], i) if expectations is None else None
+    if missing:
+      computed = dict(zip(missing, calc_all(np.asarray(all_features, dtype = float)[list(missing.values())])))
+      for key, expectations in computed.items():
+        self.cache.put(key, np.array(expectations))
+      found = [computed[key] if expectations is None else expectations for key, expectations in zip(keys, found)]
+    return np.array(found)
+
+  def clear(self):
+    self.cache.clear()
+    self.weights_key = None
+
+  def stats(self):
+    return {**self.cache.stats(), 'invalidations': self.invalidations, 'tolerance': self.tolerance}
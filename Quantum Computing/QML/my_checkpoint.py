@@ -0,0 +1,123 @@
+import os
+import copy
+import pickle
+import threading
+import numpy as np
+import time as timer
+from my_qml import spsa_state, lazy_state
+
+# --- Possible Checkpoint Settings ---
+# 'path': 'run.ckpt' # File the latest checkpoint is kept in, required
+# 'every_steps': 100 # Checkpoint every this many optimization steps, the default
+# 'every_seconds': None # Checkpoint at most this often in seconds instead, overrides every_steps
+
+def make_checkpointer(checkpoint):
+  # Builds a checkpoint_writer from a checkpoint settings dict, None when there is no checkpoint path
+  return checkpoint_writer(**checkpoint) if checkpoint else None
+
+def write_checkpoint(path, state):
+  # Writes a checkpoint atomically, the previous checkpoint stays in place until the new one is complete on disk
+  temp_path = f"{path}.tmp"
+  with open(temp_path, 'wb') as handle:
+    pickle.dump(state, handle, protocol = pickle.HIGHEST_PROTOCOL)
+    handle.flush()
+    os.fsync(handle.fileno())
+  os.replace(temp_path, path)
+
+def load_checkpoint(path):
+  # Reads a checkpoint back as the state dict train_model & quick_train_model resume from
+  with open(path, 'rb') as handle:
+    return pickle.load(handle)
+
+def training_state(mode, settings, weights, position, row_num, metrics = None, recorder = None, stopper = None, staleness = None, pending_evals = None):
+  # Everything a run needs to continue from its next step, copied so training can keep stepping the weights in place
+  # position is the (epoch, batch) of the next optimization step, pending_evals the (row_num, snapshot) pairs still being evaluated
+  return {'mode': mode, 'settings': dict(settings), 'weights': [np.array(circuit_weights) for circuit_weights in weights],
+          'epoch': position[0], 'batch': position[1], 'row_num': row_num, 'metrics': copy.deepcopy(metrics),
+          'pending_evals': [(eval_row, snapshot) for eval_row, snapshot in pending_evals] if pending_evals else [],
+          'recorder': recorder.state() if recorder else None, 'stopper': copy.deepcopy(stopper), 'staleness': list(staleness) if staleness else [],
+          'spsa_state': dict(spsa_state), 'lazy_state': copy.deepcopy(lazy_state), 'random_state': np.random.get_state(), 'saved_at': timer.time()}
+
+def restore_training_state(state, weights, recorder = None):
+  # Puts the checkpointed weights, optimizer & random state back, along with the recorder's streams, returns the weights & early stopper
+  for circuit_weights, saved_weights in zip(weights, state['weights']):
+    circuit_weights[:] = saved_weights
+  spsa_state.update(state['spsa_state'])
+  lazy_state.update(copy.deepcopy(state['lazy_state']))
+  np.random.set_state(state['random_state'])
+  recorder.restore_state(state['recorder']) if recorder and state['recorder'] else None
+  stopper = copy.deepcopy(state['stopper'])
+  if stopper:
+    stopper.start_time += timer.time() - state['saved_at'] # The time budget only counts training time
+  return weights, stopper
+
+def next_position(epoch, batch, n_batches):
+  # The (epoch, batch) after a step
+  return (epoch, batch +1) if batch +1 < n_batches else (epoch +1, 0)
+
+class checkpoint_writer:
+  def __init__(self, path, every_steps = 100, every_seconds = None):
+    # Writes checkpoints on a background thread, training only hands over a copied state and never waits on the disk
+    # Only the latest state is kept, a state submitted while the previous one is still being written replaces any older waiting one
+    self.path, self.every_steps, self.every_seconds = path, every_steps, every_seconds
+    self.latest = None
+    self.lock = threading.Lock()
+    self.pending = threading.Event()
+    self.closing = False
+    self.error = None
+    self.written = 0
+    self.last_time = timer.time()
+    self.thread = None
+
+  def start(self):
+    if self.thread is None:
+      self.closing = False
+      self.thread = threading.Thread(target = self.write_loop, daemon = True)
+      self.thread.start()
+    return self
+
+  def write_loop(self):
+    while True:
+      self.pending.wait()
+      with self.lock:
+        state, self.latest = self.latest, None
+        self.pending.clear()
+        closing = self.closing
+      if state is not None:
+        try:
+          write_checkpoint(self.path, state)
+          self.written += 1
+        except Exception as error: # Raised again in the training thread by close
+          self.error = error
+      if closing:
+        return
+
+  def due(self, row_num):
+    # Whether the step row_num should be checkpointed
+    if self.every_seconds is not None:
+      return timer.time() - self.last_time >= self.every_seconds
+    return row_num % self.every_steps == 0
+
+  def submit(self, state):
+    # Queues a state for writing and returns at once
+    self.last_time = timer.time()
+    with self.lock:
+      self.latest = state
+      self.pending.set()
+
+  def close(self):
+    # Waits for the last submitted state to be on disk
+    if self.thread is not None:
+      with self.lock:
+        self.closing = True
+        self.pending.set()
+      self.thread.join()
+      self.thread = None
+    if self.error is not None:
+      raise self.error
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc_info):
+    self.close()
@@ -44,6 +44,11 @@ def moon_circuit(features, params):
 num_feat = 2
 num_params = 5
 thread_count = 0
+backend_name = 'pennylane' # Optional, 'pennylane' runs the QNodes on dev, 'numpy' runs the built-in batched statevector engine (RX & CZ gates only)
+diff_method = 'parameter-shift' # Optional, 'parameter-shift', 'incremental-shift' (re-runs only the shifted sub-circuit's path), 'chain-rule' (per sub-circuit shifts chained across layers), 'adjoint' (always on the numpy engine) or 'spsa' (two evaluations per step)
+spsa_schedule = {'perturbation': 0.1, 'perturbation_decay': 0.101, 'gain_decay': 0.602, 'stability': 0} # Optional, SPSA step k perturbs by perturbation/(k+1)^perturbation_decay & scales alpha by ((1+stability)/(k+1+stability))^gain_decay
+prefix_cache_size = 0 # Optional, numpy engine: statevectors after each sub-circuit's feature-only prefix are kept in an LRU cache of this many entries, 0 turns it off
+parallel_rows = 1000 # Optional, calc_expectations_all splits its rows across thread_count workers above this many rows
 circuit_name = "Moon V_4"
 sub_circuits = [{'Circuit Name': 'Moon Circuit', 'Circuit Function': moon_circuit, 'Features': 2, 'Parameters': 5, 'Wires': 2}]
 
@@ -5,6 +5,7 @@ import numpy as np
 import pandas as pd
 import my_circuit_blueprint
 from my_circuit_blueprint import qml, dev, sub_circuits, circuit_name, num_params, num_feat, thread_count, num_wires, layers # Keep qml & dev
+from my_simulator import backend_name
 
 os_directory = os.getcwd()
 
@@ -42,8 +43,8 @@ def zip_df_list(df_list, folder_dir):
   os.chdir(folder_dir + "\\data")
   for (df, file_name) in zip(df_list, ["weights", "metrics", "expectations", "beta_values"]):
     # For each DataFrame in `df_list`, it saves the DataFrame as a compressed zip file with the file name "{file_name}.csv.zip" in the "data" folder
-    # If the DataFrame is `None`, it skips saving it
-    df.to_csv(f"{file_name}.csv.zip", index=False, compression="zip") if df is not None else None
+    # If the DataFrame is `None`, it skips saving it, named indices (the step of each metric evaluation) are kept as the first column
+    df.to_csv(f"{file_name}.csv.zip", index=df.index.name is not None, compression="zip") if df is not None else None
   # Changes the current working directory back to `folder_dir`
   os.chdir(folder_dir)
 
@@ -146,9 +147,10 @@ def get_circuit_settings():
   num_feats_str = f"Num Features: {num_feat}"
   num_params_str = f"Num Parameters: {num_params}"
   num_threads_str = f"Num Threads: {thread_count}"
+  backend_str = f"Backend: {backend_name}"
 
   # Returns a formatted string containing the circuit settings
-  return f"{name_str}\n{num_threads_str} || {num_wires_str} || {num_feats_str} || {num_params_str}"
+  return f"{name_str}\n{num_threads_str} || {backend_str} || {num_wires_str} || {num_feats_str} || {num_params_str}"
 
 def get_model_arch():
   tab = 0
@@ -55,10 +55,18 @@ def print_metrics_test(epoch, metrics, time_diff = None):
   print(f"                      Epoch time : {round(time_diff, 2)} seconds         ") if time_diff else None
   print("**************************************************************************") if time_diff else None
 
+def print_stop_summary(summary, monitor = 'model_accuracy'):
+  # Print why training stopped and which step's weights the model was left with
+  best_value = summary['best_' + monitor]
+  print(f"Training stopped at step {summary['stop_step']}: {summary['stop_reason']}")
+  if summary['restored_best']:
+    print(f"Restored the weights of step {summary['best_step']} with {monitor} {round(best_value, 4)}")
+
 
 def get_col_stats(df_col, window_frac = 6):
   # Calculate and return various statistics for a one-dimensional dataframe column
   stats = {}
+  window_frac = max(min(window_frac, len(df_col)//2), 1) # Decimated recordings can hold too few rows for every window to get two
   stats['mean'] = df_col.mean()
   stats['minimum'] = min(df_col)
   stats['maximum'] = max(df_col)
@@ -66,12 +74,12 @@ def get_col_stats(df_col, window_frac = 6):
   stats['mean windows'] = [0]*window_frac
   stats['variance windows'] = [0]*window_frac
 
-  window = int(len(df_col)*(1/window_frac))
+  window = max(int(len(df_col)*(1/window_frac)), 1)
 
   beg, end = 0, window
   for i in range(window_frac):
-    stats['mean windows'][i] = df_col[beg:end].mean()
-    stats['variance windows'][i] = df_col[beg:end].var()
+    stats['mean windows'][i] = df_col.iloc[beg:end].mean() # Positional, the index holds the recorded steps
+    stats['variance windows'][i] = df_col.iloc[beg:end].var()
     beg = beg + window
     end = end + window
   return stats # Returns a dictionary
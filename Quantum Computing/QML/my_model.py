@@ -1,22 +1,31 @@
 
-from my_circuit_blueprint import circuit, circuit_name
+from my_circuit_blueprint import circuit, circuit_name, thread_count
+from my_simulator import diff_method
+from my_cache import prediction_cache
+from my_recorder import train_recorder
+from my_checkpoint import load_checkpoint
 from my_training import train_model, quick_train_model
 from my_data import q_scale_data, target_data, split_data
 from my_metrics import print_df_stats, metrics_test, print_metrics_test
 from my_plots import plotly_scatter, make_train_plots, decision_plots, print_fig_dict
-from my_qml import make_weights, predict, predict_all, calc_expectations, calc_expectations_all
+from my_qml import gradient_pool, make_weights, predict, predict_all, calc_expectations, calc_expectations_all, classify_expectations_all
 from my_manager import save_version, save_recordings, load_recordings, get_circuit_settings, get_model_dir
 
 
 class quantum_model:
-  def __init__(self, n_circuits = 3, rng_seed = None, directory = get_model_dir()):
+  def __init__(self, n_circuits = 3, rng_seed = None, directory = get_model_dir(), n_workers = 1, cache_predictions = None):
     """
     Initializes a new quantum_model instance.
     Args:
         n_circuits (int): Number of circuits in the model.
         rng_seed (int): Random seed for weight initialization.
         directory (str): Directory for saving model recordings.
+        n_workers (int): Number of worker processes quick_fit trains data-parallel across, 1 trains in this process.
+        cache_predictions (dict or None): Settings of a prediction cache (see set_prediction_cache), e.g. {'max_entries': 10000, 'tolerance': 1e-6}.
     """
+    self.n_workers = n_workers
+    self.pool = gradient_pool(thread_count)
+    self.quick_pool = gradient_pool(n_workers) if n_workers > thread_count else self.pool # Only quick_fit trains data-parallel across n_workers
     self.rng_seed = rng_seed
     self.n_circuits = n_circuits
     self.circuit_name = circuit_name
@@ -24,6 +33,10 @@ class quantum_model:
     self.weights = make_weights(n_circuits, rng_seed = self.rng_seed)
     self.folder_directory = save_version(directory) if directory else None
     self.w_df, self.m_df, self.e_df, self.b_df, self.plot_dict, self.plot_list = None, None, None, None, {}, []
+    self.recorder = None
+    self.train_report = {}
+    self.predict_cache = None
+    self.set_prediction_cache(**cache_predictions) if cache_predictions else None
 
 
 
@@ -160,6 +173,8 @@ class quantum_model:
     Returns:
         array: The predicted output.
     """
+    if self.predict_cache:
+      return self.predict_all([x])[0]
     return predict(x, self.weights, self.n_circuits)
 
   def predict_all(self, X):
@@ -170,6 +185,8 @@ class quantum_model:
     Returns:
         array: The predicted outputs.
     """
+    if self.predict_cache:
+      return classify_expectations_all(self.predict_prob_all(X))
     return predict_all(X, self.weights, self.n_circuits)
 
   def predict_prob(self, x):
@@ -180,6 +197,8 @@ class quantum_model:
     Returns:
         array: The calculated expectation values.
     """
+    if self.predict_cache:
+      return list(self.predict_prob_all([x])[0])
     return calc_expectations(x, self.weights, self.n_circuits)
 
   def predict_prob_all(self, X):
@@ -190,8 +209,29 @@ class quantum_model:
     Returns:
         array: The calculated expectation values.
     """
+    if self.predict_cache:
+      return self.predict_cache.expectations_all(X, self.weights, lambda rows: calc_expectations_all(rows, self.weights, self.n_circuits))
     return calc_expectations_all(X, self.weights, self.n_circuits)
 
+  def set_prediction_cache(self, max_entries = 4096, ttl = None, max_bytes = 2**26, tolerance = None):
+    """
+    Caches the expectations the prediction methods compute, keyed by the (scaled) features they were computed for.
+    The cache is emptied whenever the weights change, through fit, quick_fit, refresh_weights, load_recordings, resume or in place.
+    Args:
+        max_entries (int): Most feature vectors kept, least recently used ones are evicted first. 0 turns the cache off.
+        ttl (float or None): Seconds an entry stays valid after it was computed, None keeps it until it is evicted.
+        max_bytes (int or None): Bound on the memory the cached expectations and keys hold, 64 MiB by default, None for no bound.
+        tolerance (float or None): Features are rounded to multiples of tolerance before the lookup, so repeated vectors that differ by
+            less share an entry. None only matches identical vectors.
+    """
+    self.predict_cache = prediction_cache(max_entries, ttl = ttl, max_bytes = max_bytes, tolerance = tolerance) if max_entries else None
+
+  def prediction_cache_stats(self):
+    """
+    Returns the prediction cache's hits, misses, hit rate, evictions, expirations, entries, bytes held and invalidations, None without a cache.
+    """
+    return self.predict_cache.stats() if self.predict_cache else None
+
 
 
 
@@ -205,7 +245,8 @@ class quantum_model:
     """
     print_metrics_test(None, metrics_test(self.weights, X_test, Y_test, self.n_circuits))
 
-  def quick_fit(self, data_tuple, alpha = 0.1, n_epochs = 10, display = False):
+  def quick_fit(self, data_tuple, alpha = 0.1, n_epochs = 10, display = False, batch_size = 1, parallel_mode = 'sync', method = diff_method,
+                optimizer = 'gradient', early_stopping = None, checkpoint = None, beta_tol = None, lazy_mode = 'defer', concurrent_circuits = False):
     """
     Trains the model using the provided data in a quick training mode.
     Args:
@@ -213,10 +254,36 @@ class quantum_model:
         alpha (float): Learning rate.
         n_epochs (int): Number of training epochs.
         display (bool): Whether to display training progress.
-    """
-    self.weights = quick_train_model(data_tuple, self.n_circuits, self.weights, alpha = alpha, n_epochs = n_epochs, display = display)
-
-  def fit(self, data_tuple, alpha = 0.1, n_epochs = 10, display = True):
+        batch_size (int): Number of samples whose gradients are computed together, averaged and applied as one step.
+            With n_workers above 1 every worker contributes batch_size samples of its shard to each step.
+        parallel_mode (str): 'sync' for lock-step data-parallel training across n_workers, 'hogwild' for lock-free asynchronous updates
+            of shared-memory weights, one sample at a time. The staleness statistics of the updates are kept in train_report.
+        method (str): Gradient estimator of every step, one of the blueprint's diff_method options, e.g. 'spsa' for two evaluations per step.
+        optimizer (str): 'gradient' for alpha-scaled gradient steps, 'rotosolve' to move every parameter to the analytic optimum of the same
+            optimize/de-optimize objective (three evaluations per parameter, alpha & method are unused).
+        early_stopping (dict or None): Stopping criteria, see my_stopping, e.g. {'patience': 3, 'monitor': 'model_accuracy'} to stop after 3 epochs
+            without improvement, 'beta_window' & 'beta_variance' to stop once beta-values settle or 'time_budget' in seconds.
+            The best evaluated weights are restored and the reason training stopped is kept in train_report.
+        checkpoint (dict or None): Checkpoint settings, see my_checkpoint, e.g. {'path': 'run.ckpt', 'every_steps': 100} or {'path': 'run.ckpt',
+            'every_seconds': 600}. The checkpoints are written atomically in the background, continue an interrupted run with resume.
+        beta_tol (float or None): Skip or defer the de-optimize gradient of a circuit whenever its step size alpha*|beta| is below beta_tol.
+            Only applies with batch_size 1, the gradient optimizer and a single worker. The gradient counts are kept in train_report.
+        lazy_mode (str): 'defer' to take the put-off steps together once their summed step size reaches beta_tol (and at every epoch end),
+            'skip' to drop them.
+        concurrent_circuits (bool): Whether every circuit's gradient of a single-sample step is taken at the pre-step weights in one batched call
+            instead of circuit by circuit. The same step for every method but 'spsa', whose circuits share the gain & perturbation of one schedule
+            step (the schedule still advances once per circuit). The batch runs in this process, without the thread_count gradient pool.
+    """
+    self.train_report = {}
+    with self.quick_pool:
+      self.weights = quick_train_model(data_tuple, self.n_circuits, self.weights, alpha = alpha, n_epochs = n_epochs, display = display,
+                                       batch_size = batch_size, n_workers = self.n_workers, parallel_mode = parallel_mode, report = self.train_report,
+                                       method = method, optimizer = optimizer, early_stopping = early_stopping, checkpoint = checkpoint,
+                                       beta_tol = beta_tol, lazy_mode = lazy_mode, concurrent_circuits = concurrent_circuits)
+
+  def fit(self, data_tuple, alpha = 0.1, n_epochs = 10, display = True, eval_every = 1, eval_seconds = None, eval_async = False, record_dir = None, record_policy = None,
+          batch_size = 1, method = diff_method, optimizer = 'gradient', early_stopping = None, checkpoint = None, beta_tol = None,
+          lazy_mode = 'defer', concurrent_circuits = False):
     """
     Trains the model using the provided data in a full training mode.
     Args:
@@ -224,8 +291,66 @@ class quantum_model:
         alpha (float): Learning rate.
         n_epochs (int): Number of training epochs.
         display (bool): Whether to display training progress.
+        eval_every (int or str): Evaluate the test set every eval_every optimization steps, or once per epoch with 'epoch'.
+        eval_seconds (float or None): Evaluate the test set at most this often in seconds instead, overrides eval_every.
+        eval_async (bool): Whether to evaluate weight snapshots on a background worker while training continues.
+        record_dir (str or None): Folder the training records stream to and are memory-mapped from afterwards. If None they stream to a new temporary
+            folder that is removed once training ends and the records are read into memory, or kept for resume when checkpointing.
+        record_policy (dict or None): Recording policy per stream ('weights'/'w_df', 'metrics'/'m_df', 'expectations'/'e_df', 'beta_values'/'b_df'),
+            each 'all' (default), an int k for every k-th row, 'epoch' for once per epoch or ('reservoir', size) for a random sample.
+        batch_size (int): Number of samples whose gradients are computed together, averaged and applied as one step.
+        method (str): Gradient estimator of every step, one of the blueprint's diff_method options, e.g. 'spsa' for two evaluations per step.
+        optimizer (str): 'gradient' for alpha-scaled gradient steps, 'rotosolve' to move every parameter to the analytic optimum of the same
+            optimize/de-optimize objective (three evaluations per parameter, alpha & method are unused).
+        early_stopping (dict or None): Stopping criteria, see my_stopping, e.g. {'patience': 5} to stop after 5 test evaluations without
+            improvement, 'beta_window' & 'beta_variance' to stop once beta-values settle or 'time_budget' in seconds.
+            The best evaluated weights are restored and the reason training stopped is kept in train_report.
+        checkpoint (dict or None): Checkpoint settings, see my_checkpoint, e.g. {'path': 'run.ckpt', 'every_steps': 100} or {'path': 'run.ckpt',
+            'every_seconds': 600}. The checkpoints are written atomically in the background, continue an interrupted run with resume.
+        beta_tol (float or None): Skip or defer the de-optimize gradient of a circuit whenever its step size alpha*|beta| is below beta_tol.
+            Only applies with batch_size 1, the gradient optimizer and a single worker. The gradient counts are kept in train_report.
+        lazy_mode (str): 'defer' to take the put-off steps together once their summed step size reaches beta_tol (and at every epoch end),
+            'skip' to drop them.
+        concurrent_circuits (bool): Whether every circuit's gradient of a single-sample step is taken at the pre-step weights in one batched call
+            instead of circuit by circuit. The same step for every method but 'spsa', whose circuits share the gain & perturbation of one schedule
+            step (the schedule still advances once per circuit). The batch runs in this process, without the thread_count gradient pool.
+    """
+    self.train_report = {}
+    self.recorder = train_recorder(record_dir, keep_files = True if checkpoint else None)
+    with self.pool:
+      self.weights, df_tuple = train_model(data_tuple, self.n_circuits, self.weights, alpha = alpha, n_epochs = n_epochs, display = display,
+                                           eval_every = eval_every, eval_seconds = eval_seconds, eval_async = eval_async, recorder = self.recorder,
+                                           record_policy = record_policy, batch_size = batch_size, method = method,
+                                           optimizer = optimizer, early_stopping = early_stopping, report = self.train_report,
+                                           checkpoint = checkpoint, beta_tol = beta_tol, lazy_mode = lazy_mode,
+                                           concurrent_circuits = concurrent_circuits)
+    train_plots, train_plot_list = make_train_plots(df_tuple, self.n_circuits)
+    self.w_df, self.m_df, self.e_df, self.b_df = df_tuple
+    self.plot_list.extend(train_plot_list)
+    self.plot_dict.update(train_plots)
+
+  def resume(self, checkpoint_path, data_tuple, display = True):
+    """
+    Continues an interrupted fit or quick_fit from its last checkpoint, at the exact step it was taken with the same settings.
+    The weights, SPSA schedule, numpy random state, early stopping state and, for fit, the recorder's streams are restored first.
+    Args:
+        checkpoint_path (str): Path of the checkpoint, the 'path' of the run's checkpoint settings.
+        data_tuple (tuple): The data tuple the run was started with.
+        display (bool): Whether to display training progress.
     """
-    self.weights, df_tuple = train_model(data_tuple, self.n_circuits, self.weights, alpha = alpha, n_epochs = n_epochs, display = display)
+    state = load_checkpoint(checkpoint_path)
+    self.n_circuits = len(state['weights'])
+    self.weights = state['weights']
+    self.train_report = {}
+    if state['mode'] == 'quick_fit':
+      with self.quick_pool:
+        self.weights = quick_train_model(data_tuple, self.n_circuits, self.weights, display = display, report = self.train_report,
+                                         resume_state = state, **state['settings'])
+      return
+    self.recorder = train_recorder(state['recorder']['record_dir'])
+    with self.pool:
+      self.weights, df_tuple = train_model(data_tuple, self.n_circuits, self.weights, display = display, recorder = self.recorder,
+                                           report = self.train_report, resume_state = state, **state['settings'])
     train_plots, train_plot_list = make_train_plots(df_tuple, self.n_circuits)
     self.w_df, self.m_df, self.e_df, self.b_df = df_tuple
     self.plot_list.extend(train_plot_list)
@@ -254,7 +379,7 @@ class quantum_model:
         window_frac (int): Fraction of the data window for calculating statistics.
     """
     print("Expectation Statistics:")
-    print_df_stats(self.e_df, window_frac = window_frac) if self.e_df else None
+    print_df_stats(self.e_df, window_frac = window_frac) if self.e_df is not None else None
 
   def print_plot_keys(self):
     """
@@ -0,0 +1,128 @@
+import numpy as np
+from my_simulator import get_numpy_plan, stack_angles, trace_circuit, angle_source, backpropagate, layer_plan, project_output, backend_name
+from my_circuit_blueprint import num_feat
+
+# The plan the configured backend runs, QNodes for 'pennylane' and compiled numpy_circuits for 'numpy'
+active_plan = get_numpy_plan() if backend_name == 'numpy' else layer_plan
+
+def downstream_steps(plan):
+  # For every step, the steps that have to be re-run when its output changes, itself first and the rest in execution order
+  steps = plan[0]
+  all_downstream = []
+  for k, step in enumerate(steps):
+    changed_slots, downstream = {step[3]}, [k]
+    for j in range(k +1, len(steps)):
+      feat_slice, out_slot = steps[j][1], steps[j][3]
+      if changed_slots.intersection(range(feat_slice.start, feat_slice.stop)):
+        changed_slots.add(out_slot)
+        downstream.append(j)
+    all_downstream.append(downstream)
+  return all_downstream
+
+plan_downstream = downstream_steps(active_plan)
+
+def shift_savings():
+  # Returns the sub-circuit executions of one incremental parameter-shift gradient and how many the full-network shift rule would have needed on top
+  steps = active_plan[0]
+  num_params = sum(param_slice.stop - param_slice.start for _, _, param_slice, _, _ in steps)
+  executed = sum(2*(steps[k][2].stop - steps[k][2].start)*len(plan_downstream[k]) for k in range(len(steps)))
+  return executed, 2*num_params*len(steps) - executed
+
+def forward_slots(features, params):
+  # Runs the plan once and keeps the value of every slot, the cache the shifted runs start from
+  steps, final_slot, num_slots = active_plan
+  slot_values = np.empty(num_slots)
+  slot_values[:len(features)] = features
+  for circ_func, feat_slice, param_slice, out_slot, projected in steps:
+    circ_output = circ_func(slot_values[feat_slice], params[param_slice])
+    slot_values[out_slot] = project_output(circ_output) if projected else circ_output
+  return slot_values
+
+def incremental_parameter_shift(features, params, report = False):
+  # Parameter-shift gradient that only re-runs the shifted sub-circuit and what sits downstream of it, every other output comes from the unshifted run
+  steps, final_slot, num_slots = active_plan
+  params = np.asarray(params, dtype = float)
+  slot_values = forward_slots(np.asarray(features, dtype = float), params)
+  gradients = np.zeros(len(params))
+
+  for k, (circ_func, feat_slice, param_slice, out_slot, projected) in enumerate(steps):
+    circ_params = params[param_slice]
+    shifts = (np.pi/2)*np.eye(len(circ_params))
+    shifted_params = np.transpose(np.concatenate([circ_params + shifts, circ_params - shifts])) # Every shift of this step's params as one batch
+    circ_output = circ_func(slot_values[feat_slice], shifted_params)
+    changed = {out_slot: project_output(circ_output) if projected else circ_output}
+
+    for j in plan_downstream[k][1:]:
+      down_func, down_feat_slice, down_param_slice, down_out_slot, down_projected = steps[j]
+      down_feats = stack_angles([changed.get(slot, slot_values[slot]) for slot in range(down_feat_slice.start, down_feat_slice.stop)])
+      circ_output = down_func(down_feats, params[down_param_slice])
+      changed[down_out_slot] = project_output(circ_output) if down_projected else circ_output
+
+    if final_slot in changed: # Params whose output never reaches the final slot have no effect on the circuit
+      evaluations = np.asarray(changed[final_slot])
+      gradients[param_slice] = 0.5*(evaluations[:len(circ_params)] - evaluations[len(circ_params):])
+
+  return (gradients, shift_savings()[1]) if report else gradients
+
+def angle_orders(plan):
+  # For every step, how many rotation gates each of its features & params drives, traced from the blueprint QNodes
+  all_orders = []
+  for circ_func, feat_slice, param_slice, _, _ in plan[0]:
+    num_circ_feats, num_circ_params = feat_slice.stop - feat_slice.start, param_slice.stop - param_slice.start
+    orders = {'features': np.zeros(num_circ_feats, dtype = int), 'params': np.zeros(num_circ_params, dtype = int)}
+    for op in trace_circuit(circ_func, num_circ_feats, num_circ_params)[0]:
+      if op.data:
+        source, index = angle_source(op.data[0])
+        orders[source][index] += 1 if source != 'const' else 0
+    all_orders.append(orders)
+  return all_orders
+
+plan_orders = angle_orders(layer_plan)
+
+def shift_rule(order):
+  # General parameter-shift rule for an angle driving `order` rotation gates (equidistant frequencies 1..order), returns its shifts & coefficients
+  mu = np.arange(1, 2*order +1)
+  shifts = (2*mu -1)*np.pi/(2*order)
+  return shifts, (-1.0)**(mu -1)/(4*order*np.sin(shifts/2)**2)
+
+def shifted_rows(values, orders):
+  # One copy of values per (angle, shift) pair, with the coefficient and angle index of each copy
+  rows, coefficients, owners = [np.zeros([0, len(values)])], [np.zeros(0)], [np.zeros(0, dtype = int)]
+  for i, order in enumerate(orders):
+    if order:
+      shifts, coeffs = shift_rule(order)
+      shifted = np.tile(values, (len(shifts), 1))
+      shifted[:, i] += shifts
+      rows.append(shifted)
+      coefficients.append(coeffs)
+      owners.append(np.full(len(shifts), i))
+  return np.concatenate(rows), np.concatenate(coefficients), np.concatenate(owners)
+
+def local_derivatives(circ_func, circ_feats, circ_params, orders, input_grads = True):
+  # Value of one sub-circuit and its derivatives wrt its inputs & params, every shifted run of the sub-circuit goes out as one batch
+  feat_rows, feat_coeffs, feat_owners = shifted_rows(circ_feats, orders['features'] if input_grads else [])
+  param_rows, param_coeffs, param_owners = shifted_rows(circ_params, orders['params'])
+  all_feat_rows = np.concatenate([circ_feats[None], feat_rows, np.tile(circ_feats, (len(param_rows), 1))])
+  all_param_rows = np.concatenate([circ_params[None], np.tile(circ_params, (len(feat_rows), 1)), param_rows])
+
+  evaluations = np.asarray(circ_func(np.transpose(all_feat_rows), np.transpose(all_param_rows)))
+  feat_evals, param_evals = evaluations[1:len(feat_rows) +1], evaluations[len(feat_rows) +1:]
+  feat_grads = np.bincount(feat_owners, weights = feat_coeffs*feat_evals, minlength = len(circ_feats)) if input_grads else None
+  param_grads = np.bincount(param_owners, weights = param_coeffs*param_evals, minlength = len(circ_params))
+  return evaluations[0], feat_grads, param_grads
+
+def chain_rule_gradient(features, params):
+  # Gradient of the layered network from local parameter-shift derivatives inside each sub-circuit, chained across the layers
+  steps, final_slot, num_slots = active_plan
+  params = np.asarray(params, dtype = float)
+  slot_values = np.empty(num_slots)
+  slot_values[:len(features)] = features
+  local_grads = []
+
+  for (circ_func, feat_slice, param_slice, out_slot, projected), orders in zip(steps, plan_orders):
+    input_grads = feat_slice.stop > num_feat # Derivatives wrt the data features themselves are never needed
+    value, feat_grads, param_grads = local_derivatives(circ_func, slot_values[feat_slice], params[param_slice], orders, input_grads)
+    slot_values[out_slot] = project_output(value) if projected else value
+    local_grads.append((feat_grads, param_grads))
+
+  return backpropagate(active_plan, local_grads, len(params))
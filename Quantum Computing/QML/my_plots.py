@@ -112,14 +112,15 @@ def make_train_plots(df_tuple, n_circuits, frac_window=10):
     weight_plots[f"C_{i}"] = get_subset(w_df, f"C_{i}").plot(title=f"Circuit {i} Parameters over Optimization", template=plot_template)
     expect_plots[f"C_{i}"] = get_subset(e_df, f"C_{i}").plot(title=f"Circuit {i} Expectations over Optimization", template=plot_template)
 
-  # Set the window size for rolling mean and variance
-  window = int(len(e_df) * (1 / frac_window))
+  # Set the window size for rolling mean and variance, in recorded rows since each stream can be decimated differently
+  beta_window = max(int(len(b_df) * (1 / frac_window)), 2)
+  expect_window = max(int(len(e_df) * (1 / frac_window)), 2)
   # Plot rolling mean of beta-values and expectations
-  beta_plots["Mean"] = b_df.rolling(window).mean().plot(title='Beta-values rolling mean with window of ' + str(window), template=plot_template)
-  expect_plots["Mean"] = e_df.rolling(window).mean().plot(title='Expectations rolling mean with window of ' + str(window), template=plot_template)
+  beta_plots["Mean"] = b_df.rolling(beta_window).mean().plot(title='Beta-values rolling mean with window of ' + str(beta_window), template=plot_template)
+  expect_plots["Mean"] = e_df.rolling(expect_window).mean().plot(title='Expectations rolling mean with window of ' + str(expect_window), template=plot_template)
   # Plot rolling variance of beta-values and expectations
-  beta_plots["Variance"] = b_df.rolling(window).var().plot(title='Beta-values rolling variance with window of ' + str(window), template=plot_template)
-  expect_plots["Variance"] = e_df.rolling(window).var().plot(title='Expectations rolling variance with window of ' + str(window), template=plot_template)
+  beta_plots["Variance"] = b_df.rolling(beta_window).var().plot(title='Beta-values rolling variance with window of ' + str(beta_window), template=plot_template)
+  expect_plots["Variance"] = e_df.rolling(expect_window).var().plot(title='Expectations rolling variance with window of ' + str(expect_window), template=plot_template)
 
   # Create a dictionary to store all plots
   plot_dict["Beta"] = beta_plots
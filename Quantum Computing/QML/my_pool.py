@@ -0,0 +1,72 @@
+import os
+import numpy as np
+from multiprocessing import resource_tracker, Value
+from multiprocessing.pool import Pool as call_thread_pool
+
+# Pools currently entered with 'with', innermost last
+active_pools = []
+
+# Set inside pool workers, which inherit the parent's active_pools on fork but can't use them or start pools of their own
+worker_state = {'in_worker': False}
+
+def init_worker(initializer, seed_sequence, worker_count):
+  # Runs in every new worker before its first task, forked workers would otherwise all draw the parent's numpy random stream
+  # Each worker reseeds numpy's global generator with its own child of the pool's seed sequence
+  active_pools.clear()
+  worker_state['in_worker'] = True
+  with worker_count.get_lock():
+    worker_index, worker_count.value = worker_count.value, worker_count.value +1
+  np.random.seed(np.random.SeedSequence(seed_sequence.entropy, spawn_key = (worker_index,)).generate_state(4))
+  initializer() if initializer else None
+
+def in_worker():
+  # Whether the current process is a pool worker
+  return worker_state['in_worker']
+
+class worker_pool:
+  def __init__(self, processes, initializer = None, min_processes = 2):
+    # Long-lived process pool, the workers are started once and reused for every task until the pool is closed
+    self.processes = processes
+    self.initializer = initializer
+    self.min_processes = min_processes
+    self.pool = None
+    self.depth = 0
+
+  def start(self):
+    # Starts the workers, pools below min_processes never start and leave the caller to run serially
+    if self.pool is None and self.processes >= self.min_processes and not in_worker():
+      resource_tracker.ensure_running() if os.name == 'posix' else None # Workers share the parent's tracker, so shared memory they attach stays owned by its creator
+      seed_sequence = np.random.SeedSequence(np.random.randint(2**32, size = 4)) # Drawn from the parent's generator so its seed covers the workers
+      self.pool = call_thread_pool(processes = self.processes, initializer = init_worker, initargs = (self.initializer, seed_sequence, Value('i', 0)))
+    return self
+
+  def close(self):
+    # Lets the workers finish their tasks and waits for them to exit
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+
+  def starmap(self, func, input_list):
+    # Runs func(*args) for every args in input_list, split into one chunk per worker to keep dispatch down
+    chunksize = max(1, -(-len(input_list)//self.processes))
+    return self.pool.starmap(func, input_list, chunksize = chunksize)
+
+  def apply_async(self, func, args = ()):
+    # Queues func(*args) on a worker and returns its AsyncResult
+    return self.pool.apply_async(func, args)
+
+  def __enter__(self):
+    self.depth += 1
+    active_pools.append(self.start())
+    return self
+
+  def __exit__(self, *exc_info):
+    self.depth -= 1
+    active_pools.remove(self)
+    if self.depth == 0:
+      self.close()
+
+def get_active_pool():
+  # Returns the innermost started pool, None outside of a 'with worker_pool(...)' block, pools too small to start don't hide the ones around them
+  return next((pool for pool in reversed(active_pools) if pool.pool is not None), None)
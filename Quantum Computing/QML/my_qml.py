@@ -1,18 +1,45 @@
 
 import numpy as np
-from multiprocessing.pool import Pool as call_thread_pool
+from multiprocessing import shared_memory
+from my_pool import worker_pool, get_active_pool, in_worker
 #from my_circuit import qml, dev, circuit, num_feat, num_params, thread_count # Keep qml & dev
-from my_circuit_blueprint import qml, dev, circuit, num_feat, num_params, thread_count # Keep qml & dev
+from my_circuit_blueprint import qml, dev, num_feat, num_params, thread_count # Keep qml & dev
+from my_simulator import batch_circuit, plan_circuit, adjoint_gradient, backend_name, diff_method, parallel_rows, spsa_schedule
+from my_network import incremental_parameter_shift, chain_rule_gradient
+
+# Circuit evaluations in this process, 'dispatches' counts calls to the backend and 'executions' the circuits they evaluate (one per batch row)
+execution_counts = {'dispatches': 0, 'executions': 0}
+
+def count_executions(executions):
+  execution_counts['dispatches'] += 1
+  execution_counts['executions'] += executions
+
+def reset_execution_counts():
+  execution_counts['dispatches'], execution_counts['executions'] = 0, 0
+
+# Returns a copy of the counters, pool workers keep counters of their own
+def get_execution_counts():
+  return dict(execution_counts)
+
+# Evaluates the circuit on the configured backend, 2-D features and/or params are evaluated row by row in a single call
+def run_circuit(features, params):
+  features_T = np.transpose(np.asarray(features, dtype = float)) # Rows become trailing batch axes, the layout PennyLane broadcasting expects
+  params_T = np.transpose(np.asarray(params, dtype = float))
+  count_executions(max(len(features_T[0]) if features_T.ndim == 2 else 1, len(params_T[0]) if params_T.ndim == 2 else 1))
+
+  if backend_name == 'numpy':
+    return batch_circuit(features_T, params_T)
+  return plan_circuit(features_T, params_T)
 
 # Calculates the gradient of a single parameter 
 def parameter_shift_term(features, params, i):
   shifted = params.copy()
   
   shifted[i] += np.pi/2                 # shift parameter i forward by pi/2
-  forward = circuit(features, shifted)  # forward evaluation
+  forward = run_circuit(features, shifted)  # forward evaluation
 
   shifted[i] -= np.pi                   # shift parameter i backward by pi/2, (pi/2 - pi = -pi/2)
-  backward = circuit(features, shifted) # backward evaluation
+  backward = run_circuit(features, shifted) # backward evaluation
 
   return 0.5* (forward - backward) # the difference between the forward shift and backward shift is twice the gradient
 
@@ -25,32 +52,162 @@ def parameter_shift(features, params):
 
   return gradients # return the gradients of all parameters in a vector
 
+# Stacks every forward shifted copy of params followed by every backward shifted copy, a (2*num_params, num_params) matrix
+def shift_matrix(params):
+  shifts = (np.pi/2)*np.eye(len(params))
+  return np.concatenate([params + shifts, params - shifts])
+
+# Calculates the gradients for all parameters from a single broadcast evaluation of every shifted copy of params
+def broadcast_parameter_shift(features, params):
+  evaluations = run_circuit(features, shift_matrix(np.asarray(params, dtype = float)))
+
+  return 0.5*(evaluations[:len(params)] - evaluations[len(params):]) # forward half minus backward half is twice the gradient
+
+# Pool initializer, builds the device & compiles the circuits in each worker ahead of the first task
+def warm_worker():
+  run_circuit(np.zeros(num_feat), np.zeros(num_params))
+
+# Returns a (not yet started) pool of warm workers, start it with 'with' around training
+def gradient_pool(processes = thread_count):
+  return worker_pool(processes, initializer = warm_worker)
+
 def thread_parameter_shift(features, params):
 
-  threading_pool = call_thread_pool(processes = thread_count)
+  threading_pool = get_active_pool()
+  if threading_pool is None:
+    with gradient_pool() as threading_pool: # Outside of a 'with' block a temporary pool is started and shut down around the call
+      return thread_parameter_shift(features, params)
+
   input_list = [(features, params, i) for i in range(len(params))]
   gradients = np.array(threading_pool.starmap(parameter_shift_term, input_list))
   
   return gradients
 
-def quantum_gradient(features, params):
-  if thread_count <= 1:
-    return parameter_shift(features, params)
+# Calculates the gradients with one forward and one backward statevector sweep, matches parameter_shift on single-circuit blueprints
+def adjoint_differentiation(features, params):
+  count_executions(1) # One forward & one backward sweep of the circuit
+  return adjoint_gradient(np.asarray(features, dtype = float), np.asarray(params, dtype = float))
+
+# SPSA schedule & step counter of this process, every SPSA gradient estimate is one step
+spsa_state = {'step': 0, **spsa_schedule}
+
+# Restarts the SPSA schedule at step 0, optionally with new schedule settings
+def reset_spsa(**settings):
+  spsa_state.update({'step': 0, **spsa_schedule, **settings})
+
+# Perturbation size & gain of SPSA step k
+def spsa_step_sizes(k, state = spsa_state):
+  perturbation = state['perturbation']/(k +1)**state['perturbation_decay']
+  gain = ((1 + state['stability'])/(k +1 + state['stability']))**state['gain_decay']
+  return perturbation, gain
+
+# Random +-1 direction for every parameter of every row, drawn from numpy's global generator so make_weights' seed covers it
+def spsa_directions(shape):
+  return np.random.choice([-1.0, 1.0], size = shape)
+
+# Simultaneous perturbation estimate of the gradient from two evaluations whatever the number of params, scaled by the gain schedule
+def spsa_gradient(features, params, state = spsa_state):
+  perturbation, gain = spsa_step_sizes(state['step'], state)
+  state['step'] += 1
+  direction = spsa_directions(len(params))
+  evaluations = run_circuit(features, np.array([params + perturbation*direction, params - perturbation*direction]))
+  return gain*(evaluations[0] - evaluations[1])/(2*perturbation)*direction
+
+def quantum_gradient(features, params, method = diff_method):
+  if method == 'spsa':
+    return spsa_gradient(features, np.asarray(params, dtype = float))
+  if method == 'adjoint':
+    return adjoint_differentiation(features, params)
+  if method == 'incremental-shift':
+    return incremental_parameter_shift(features, params)
+  if method == 'chain-rule':
+    return chain_rule_gradient(features, params)
+  if thread_count <= 1 or in_worker():
+    return broadcast_parameter_shift(features, params)
   else:
     return thread_parameter_shift(features, params)
 
+# Evaluates the circuit and its gradient for every (features, params) row pair in one call, returns the values (rows,) and gradients (rows, num_params)
+# The adjoint method sweeps the whole batch at once, SPSA perturbs every row in its own direction as one step of its schedule,
+# chained sub-circuit derivatives aren't the network's shift rule on layered blueprints so 'chain-rule' takes every row on its own,
+# the parameter-shift methods all run as one batch of every row's shifted copies
+def batch_value_and_gradient(feature_rows, param_rows, method = diff_method):
+  feature_rows, param_rows = np.asarray(feature_rows, dtype = float), np.asarray(param_rows, dtype = float)
+  if method == 'chain-rule':
+    return run_circuit(feature_rows, param_rows), np.array([chain_rule_gradient(features, params) for features, params in zip(feature_rows, param_rows)])
+  if method == 'adjoint':
+    count_executions(len(param_rows))
+    return run_circuit(feature_rows, param_rows), np.transpose(adjoint_gradient(np.transpose(feature_rows), np.transpose(param_rows)))
+  if method == 'spsa':
+    perturbation, gain = spsa_step_sizes(spsa_state['step'])
+    spsa_state['step'] += 1
+    directions = spsa_directions(param_rows.shape)
+    evaluations = np.reshape(run_circuit(np.tile(feature_rows, (3, 1)), np.concatenate([param_rows, param_rows + perturbation*directions, param_rows - perturbation*directions])), (3, -1))
+    return evaluations[0], gain*((evaluations[1] - evaluations[2])/(2*perturbation))[:, None]*directions
+
+  num_rows, n_params = param_rows.shape
+  shifted_rows = np.reshape([shift_matrix(params) for params in param_rows], (num_rows*2*n_params, n_params)) # Every shifted copy of every row
+  evaluations = run_circuit(np.concatenate([feature_rows, np.repeat(feature_rows, 2*n_params, axis = 0)]), np.concatenate([param_rows, shifted_rows]))
+  shifted_evals = np.reshape(evaluations[num_rows:], (num_rows, 2*n_params))
+
+  return evaluations[:num_rows], 0.5*(shifted_evals[:, :n_params] - shifted_evals[:, n_params:])
+
 # Adjusts all parameters in a given circuit using the gradient to 'optimize' or 'de-optimize'
-def step_function(features, params, alpha = 0.1, beta = 1):
+def step_function(features, params, alpha = 0.1, beta = 1, method = diff_method):
   # Each dependent variable will have possible targets that span that variable (possible values of the variable)
   # Each circuit can be 'optimized' to a specific target or 'de-optimized' to a specific target
 
   # Each parameter is 'optimized' by moving in the positive direction (positive gradient) or 'de-optimized' by...
   # moving in the negative direction (negative gradient)
 
-  params += (alpha*beta)*quantum_gradient(features, params)
+  params += (alpha*beta)*quantum_gradient(features, params, method = method)
 
   return params
 
+# De-optimize steps put off by a beta_tol, the (features, beta) pairs waiting per circuit and counts of the de-optimize gradients of this process
+# 'computed' were taken in their step, 'skipped' were dropped, 'deferred' were put off and 'flushed' were later taken in batches
+lazy_state = {'waiting': {}, 'computed': 0, 'skipped': 0, 'deferred': 0, 'flushed': 0}
+
+def reset_lazy():
+  lazy_state.update({'waiting': {}, 'computed': 0, 'skipped': 0, 'deferred': 0, 'flushed': 0})
+
+# Returns a copy of the counters, without the waiting steps
+def get_lazy_counts():
+  return {key: value for key, value in lazy_state.items() if key != 'waiting'}
+
+# De-optimize step of circuit j that only takes the gradient when the effective step size alpha*|beta| reaches beta_tol
+# Smaller steps are dropped with lazy_mode 'skip', with 'defer' they wait until their summed step size reaches beta_tol and are then taken
+# together in one batched call at the current weights
+def lazy_step_function(features, params, j, alpha = 0.1, beta = 1, beta_tol = 0.0, lazy_mode = 'defer', method = diff_method):
+  if alpha*abs(beta) >= beta_tol:
+    lazy_state['computed'] += 1
+    return step_function(features, params, alpha = alpha, beta = beta, method = method)
+  if lazy_mode == 'skip':
+    lazy_state['skipped'] += 1
+    return params
+  waiting = lazy_state['waiting'].setdefault(j, [])
+  waiting.append((np.array(features, dtype = float), beta))
+  lazy_state['deferred'] += 1
+  if alpha*sum(abs(waiting_beta) for _, waiting_beta in waiting) >= beta_tol:
+    params = flush_lazy_circuit(params, j, alpha = alpha, method = method)
+  return params
+
+# Takes the waiting de-optimize steps of circuit j in one call
+def flush_lazy_circuit(params, j, alpha = 0.1, method = diff_method):
+  waiting = lazy_state['waiting'].pop(j, [])
+  if waiting:
+    feature_rows, betas = np.array([features for features, _ in waiting]), np.array([beta for _, beta in waiting])
+    _, gradients = batch_value_and_gradient(feature_rows, np.tile(params, (len(waiting), 1)), method = method)
+    params += alpha*(betas @ gradients)
+    lazy_state['flushed'] += len(waiting)
+  return params
+
+# Takes every waiting de-optimize step, so none are lost at the end of an epoch
+def flush_lazy(weights, alpha = 0.1, method = diff_method):
+  for j in list(lazy_state['waiting']):
+    weights[j] = flush_lazy_circuit(weights[j], j, alpha = alpha, method = method)
+  return weights
+
 # Helper/utility function for initializing weights at random, can be seeded
 def make_weights(n_circuits, rng_seed = None):
   weights = [None]*n_circuits # Initialize weights
@@ -70,29 +227,73 @@ def make_features(rng_seed = None):
 
   return features
 
-def calc_expectations(features, weights, n_circuits):
-  expectations = [0]*n_circuits # Initialize zeros for classifier
-  
-  for i in range(n_circuits):
-    expectations[i] = (circuit(features, weights[i]) +1)/2 # Get the expectation value from each circuit, one for each target
-
-  return expectations # Return expectations
+# Stacks the weights of every circuit into one (n_circuits, num_params) array, one row per circuit
+def stack_weights(weights, n_circuits):
+  return np.asarray([weights[i] for i in range(n_circuits)], dtype = float)
 
-def calc_expectations_all(all_features, weights, n_circuits):
-  all_expectations = [[0]*n_circuits]*len(all_features)
-
-  for i, feature in enumerate(all_features):
-    all_expectations[i] = calc_expectations(feature, weights, n_circuits)
+def calc_expectations(features, weights, n_circuits):
+  stacked_weights = stack_weights(weights, n_circuits) # Every circuit shares the same architecture, so all of them run as one batch
+  expectations = (run_circuit(features, stacked_weights) +1)/2 # Get the expectation value from each circuit, one for each target
+
+  return list(expectations) # Return expectations
+
+def calc_expectations_all(all_features, weights, n_circuits, row_threshold = parallel_rows):
+  if thread_count > 1 and len(all_features) > row_threshold and not in_worker():
+    return thread_calc_expectations_all(all_features, weights, n_circuits)
+
+  all_features = np.asarray(all_features, dtype = float)
+  stacked_weights = stack_weights(weights, n_circuits)
+
+  feature_rows = np.repeat(all_features, n_circuits, axis = 0) # One row for every (feature, circuit) pair, evaluated in a single call
+  weight_rows = np.tile(stacked_weights, (len(all_features), 1))
+  all_expectations = (run_circuit(feature_rows, weight_rows) +1)/2
+
+  return np.reshape(all_expectations, (len(all_features), n_circuits))
+
+# Copies an array into a new shared memory block, returns the block and an array on top of it
+def share_array(array):
+  block = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+  shared = np.ndarray(array.shape, dtype = float, buffer = block.buf)
+  shared[:] = array
+  return block, shared
+
+# Attaches to a shared memory block made by share_array, returns the block and an array on top of it
+def attach_array(name, shape):
+  block = shared_memory.SharedMemory(name = name) # Pool workers share the creator's resource tracker (see worker_pool.start), which only unlinks it once
+  return block, np.ndarray(shape, dtype = float, buffer = block.buf)
+
+# Worker task, evaluates rows start:stop of the shared feature matrix into the same rows of the shared output
+def calc_expectations_rows(names, shapes, start, stop, n_circuits):
+  blocks, (all_features, stacked_weights, all_expectations) = zip(*[attach_array(name, shape) for name, shape in zip(names, shapes)])
+  all_expectations[start:stop] = calc_expectations_all(all_features[start:stop], stacked_weights, n_circuits, row_threshold = np.inf)
+  del all_features, stacked_weights, all_expectations # Views on the buffers have to go before the blocks can close
+  for block in blocks:
+    block.close()
+
+# Splits the rows of all_features across the worker pool, the features, weights and results live in shared memory instead of being pickled per task
+def thread_calc_expectations_all(all_features, weights, n_circuits):
+  threading_pool = get_active_pool()
+  if threading_pool is None:
+    with gradient_pool() as threading_pool: # Outside of a 'with' block a temporary pool is started and shut down around the call
+      return thread_calc_expectations_all(all_features, weights, n_circuits)
+
+  all_features = np.asarray(all_features, dtype = float)
+  arrays = [all_features, stack_weights(weights, n_circuits), np.zeros([len(all_features), n_circuits])] # The last array is the preallocated output
+  blocks, shared = zip(*[share_array(array) for array in arrays])
+  try:
+    names, shapes = [block.name for block in blocks], [array.shape for array in arrays]
+    bounds = np.linspace(0, len(all_features), threading_pool.processes +1).astype(int)
+    input_list = [(names, shapes, start, stop, n_circuits) for start, stop in zip(bounds[:-1], bounds[1:])]
+    threading_pool.starmap(calc_expectations_rows, input_list)
+    all_expectations = shared[-1].copy()
+  finally:
+    del shared
+    for block in blocks:
+      block.close()
+      block.unlink()
 
   return all_expectations
 
-# TODO
-# def thread_calc_expectations_all(all_features, weights, n_circuits, num_threads):
-#   threading_pool = call_thread_pool(processes = num_threads)
-#   input_list = [(features, params, i) for i in range(len(params))]
-#   gradients = np.array(threading_pool.starmap(parameter_shift_term, input_list))
-#   return gradients
-
 def classify_expectations(expectations):
 
   classification = np.argmax(expectations) # Get the index of the largest expectation value, which is taken as the predicted value
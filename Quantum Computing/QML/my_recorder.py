@@ -0,0 +1,151 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Streams recorded by train_model, named after the files save_recordings writes them to
+stream_names = ["weights", "metrics", "expectations", "beta_values"]
+
+# The DataFrame each stream is read back as, record policies can name either
+df_streams = {"w_df": "weights", "m_df": "metrics", "e_df": "expectations", "b_df": "beta_values"}
+
+# --- Possible Record Policies ---
+# 'all' # Every row, the default
+# k # Every k-th row along with the first & last rows, e.g. every k-th step for weights or every k-th evaluation for metrics
+# 'epoch' # The first row and the rows at the end of every epoch
+# ('reservoir', size) # A uniform random sample of size rows, kept in memory and written out sorted by step
+
+def stream_policies(record_policy):
+  # Maps a record_policy dict keyed by stream or DataFrame name to a policy for every stream
+  record_policy = record_policy if record_policy else {}
+  policies = {df_streams.get(name, name): policy for name, policy in record_policy.items()}
+  for name, policy in policies.items():
+    if name not in stream_names:
+      raise ValueError(f"Unknown record stream {name}, streams are {stream_names} or {list(df_streams)}")
+    if not (policy in ['all', 'epoch'] or (isinstance(policy, int) and policy > 0) or (isinstance(policy, tuple) and policy[0] == 'reservoir')):
+      raise ValueError(f"Unknown record policy {policy} for {name}, use 'all', 'epoch', an int k > 0 or ('reservoir', size)")
+  return {name: policies.get(name, 'all') for name in stream_names}
+
+def data_path(record_dir, name):
+  return os.path.join(record_dir, f"{name}.f64")
+
+def header_path(record_dir, name):
+  return os.path.join(record_dir, f"{name}.json")
+
+def read_header(record_dir, name):
+  # Returns the column names & number of complete rows of a stream, rows only count once they are on disk
+  with open(header_path(record_dir, name)) as handle:
+    return json.load(handle)
+
+def read_stream(record_dir, name):
+  # Memory-maps a recorded stream as a DataFrame indexed by step, the rows are paged in from disk as they are used
+  header = read_header(record_dir, name)
+  n_cols = len(header['columns']) +1
+  if header['rows'] == 0:
+    return pd.DataFrame(np.zeros([0, n_cols -1]), columns = header['columns'], index = pd.Index([], dtype = int, name = 'step'))
+  data = np.memmap(data_path(record_dir, name), dtype = np.float64, mode = 'r', shape = (header['rows'], n_cols))
+  return pd.DataFrame(data[:, 1:], columns = header['columns'], index = pd.Index(data[:, 0].astype(int), name = 'step'))
+
+def read_recording(record_dir):
+  # Rebuilds the (w_df, m_df, e_df, b_df) tuple of a training run from its record_dir, also after a crash
+  return tuple(read_stream(record_dir, name) for name in stream_names)
+
+
+class train_recorder:
+  def __init__(self, record_dir = None, chunk_rows = 256, rng_seed = None, keep_files = None):
+    # Appends training records to raw float64 files in record_dir (a new temporary folder by default), only chunk_rows rows per stream are held in memory
+    # The files are kept when keep_files is set or a record_dir is given, a temporary folder is otherwise removed once dataframes reads it into memory
+    self.keep_files = keep_files if keep_files is not None else record_dir is not None
+    self.record_dir = record_dir if record_dir else tempfile.mkdtemp(prefix = 'qml_recording_')
+    self.chunk_rows = chunk_rows
+    self.rng = np.random.default_rng(rng_seed) # Picks the rows of reservoir streams
+    self.streams = {}
+    os.makedirs(self.record_dir, exist_ok = True)
+
+  def add_stream(self, name, columns, policy = 'all'):
+    # Starts an empty stream, every row is stored as [step, *values], reservoir streams buffer their whole sample instead of a chunk
+    buffer_rows = policy[1] if isinstance(policy, tuple) else self.chunk_rows
+    self.streams[name] = {'columns': list(columns), 'policy': policy, 'buffer': np.zeros([buffer_rows, len(columns) +1]),
+                          'buffered': 0, 'rows': 0, 'offered': 0, 'slot': 0}
+    open(data_path(self.record_dir, name), 'wb').close()
+    self.write_header(name)
+
+  def record_due(self, name, epoch_end = False, final = False):
+    # Whether the next row offered to a stream is kept under its policy, checked before the row is built so skipped rows cost nothing
+    stream = self.streams[name]
+    policy, n = stream['policy'], stream['offered']
+    stream['offered'] += 1
+    if policy == 'all':
+      return True
+    if policy == 'epoch':
+      return n == 0 or epoch_end or final
+    if isinstance(policy, int):
+      return n % policy == 0 or final
+    stream['slot'] = n if n < policy[1] else self.rng.integers(n +1) # Reservoir sampling, the n-th row replaces a kept row with probability size/(n+1)
+    return stream['slot'] < policy[1]
+
+  def write_header(self, name):
+    # The json sidecar is rewritten after every flush, so it never counts rows that aren't fully on disk
+    stream = self.streams[name]
+    with open(header_path(self.record_dir, name), 'w') as handle:
+      json.dump({'columns': stream['columns'], 'rows': stream['rows'], 'dtype': 'float64'}, handle)
+
+  def append(self, name, step, values):
+    # Buffers one row, writing the buffer out once it holds chunk_rows rows, reservoir rows go to the slot record_due picked
+    stream = self.streams[name]
+    if isinstance(stream['policy'], tuple):
+      stream['buffer'][stream['slot']] = np.concatenate([[step], values])
+      stream['buffered'] = min(stream['offered'], len(stream['buffer']))
+      return
+    stream['buffer'][stream['buffered'], 0] = step
+    stream['buffer'][stream['buffered'], 1:] = values
+    stream['buffered'] += 1
+    if stream['buffered'] == self.chunk_rows:
+      self.flush_stream(name)
+
+  def flush_stream(self, name):
+    # Appends the buffered rows of a stream to its file, a reservoir stream rewrites its file with the current sample
+    stream = self.streams[name]
+    if isinstance(stream['policy'], tuple):
+      sample = stream['buffer'][:stream['buffered']]
+      with open(data_path(self.record_dir, name), 'wb') as handle:
+        handle.write(sample[np.argsort(sample[:, 0], kind = 'stable')].tobytes())
+      stream['rows'] = stream['buffered']
+      self.write_header(name)
+    elif stream['buffered']:
+      with open(data_path(self.record_dir, name), 'ab') as handle:
+        handle.write(stream['buffer'][:stream['buffered']].tobytes())
+      stream['rows'] += stream['buffered']
+      stream['buffered'] = 0
+      self.write_header(name)
+
+  def flush(self):
+    for name in self.streams:
+      self.flush_stream(name)
+
+  def state(self):
+    # Copy of the stream counters & buffered rows for a checkpoint, the rows already on disk are only counted
+    return {'record_dir': self.record_dir, 'chunk_rows': self.chunk_rows, 'rng': self.rng.bit_generator.state,
+            'streams': {name: {**stream, 'buffer': stream['buffer'].copy()} for name, stream in self.streams.items()}}
+
+  def restore_state(self, state):
+    # Rolls the streams back to a checkpointed state, rows written to the files after it was taken are cut off
+    self.rng.bit_generator.state = state['rng']
+    self.streams = {name: {**stream, 'buffer': stream['buffer'].copy()} for name, stream in state['streams'].items()}
+    for name, stream in self.streams.items():
+      if isinstance(stream['policy'], tuple):
+        self.flush_stream(name) # Rewrites the checkpointed sample
+        continue
+      os.truncate(data_path(self.record_dir, name), stream['rows']*(len(stream['columns']) +1)*8)
+      self.write_header(name)
+
+  def dataframes(self):
+    # Flushes every stream and returns the recording as DataFrames, memory-mapped from the kept files or copied into memory before they are removed
+    self.flush()
+    frames = read_recording(self.record_dir)
+    if not self.keep_files:
+      frames = tuple(df.copy() for df in frames)
+      shutil.rmtree(self.record_dir, ignore_errors = True)
+    return frames
@@ -0,0 +1,47 @@
+import numpy as np
+from my_circuit_blueprint import num_params
+from my_qml import run_circuit, stack_weights, calc_expectations_all
+
+# Every RX parameter enters the circuit as a sinusoid, f(theta) = C + R sin(theta - phi + psi) around the current value phi, and so does any
+# weighted sum of such circuits over a batch of samples. Three evaluations, at phi and phi +- pi/2, pin down C, R & psi and with them the maximum.
+# This is exact for a parameter driving a single rotation whose output is the circuit's output, deeper parameters of layered blueprints are
+# passed through project_output into later sub-circuits and only get an approximate (coordinate-wise heuristic) step.
+
+def rotosolve_angle(phi, f_zero, f_plus, f_minus):
+  # Returns the angle maximizing the sinusoid through f(phi) = f_zero & f(phi +- pi/2) = f_plus & f_minus, with the maximum itself
+  offset = (f_plus + f_minus)/2
+  psi = np.arctan2(f_zero - offset, (f_plus - f_minus)/2)
+  amplitude = np.sqrt((f_zero - offset)**2 + ((f_plus - f_minus)/2)**2)
+  return phi + np.pi/2 - psi, offset + amplitude
+
+def objective_scales(X_batch, Y_batch, weights, n_circuits):
+  # Weight of every (sample, circuit) expectation in each circuit's objective, +1 for the sample's target and beta (< 0) for the others,
+  # the same objective the gradient step climbs, along with the betas & expectations at the given weights
+  samples = np.arange(len(X_batch))
+  expectations = calc_expectations_all(X_batch, weights, n_circuits)
+  betas = expectations[samples, Y_batch]/np.sum(expectations, axis = 1) - 1 # Classic
+  return np.where(np.arange(n_circuits) == Y_batch[:, None], 1.0, betas[:, None]), betas, expectations
+
+def rotosolve_step(X_batch, Y_batch, weights, n_circuits, post_expectations = True):
+  # One sweep over the parameters, every parameter of every circuit is moved to the maximum of its circuit's objective over the batch
+  # Coordinates are solved one after the other, but every circuit solves its coordinate d in the same call (2 evaluations per sample & circuit)
+  batch_length = len(X_batch)
+  X_batch, Y_batch = np.asarray(X_batch, dtype = float), np.asarray(Y_batch, dtype = int)
+  scales, betas, expectations = objective_scales(X_batch, Y_batch, weights, n_circuits)
+  stacked_weights = stack_weights(weights, n_circuits)
+  objectives = np.mean(scales*(2*expectations -1), axis = 0) # Objective of each circuit on the raw circuit outputs, before the (x+1)/2 rescale
+
+  feature_rows = np.tile(np.repeat(X_batch, n_circuits, axis = 0), (2, 1)) # (shift, sample, circuit) order
+  for d in range(num_params):
+    shifted_weights = np.tile(stacked_weights, (2*batch_length, 1))
+    shifted_weights[:, d] += np.repeat([np.pi/2, -np.pi/2], batch_length*n_circuits)
+    evaluations = np.reshape(run_circuit(feature_rows, shifted_weights), (2, batch_length, n_circuits))
+    f_plus, f_minus = np.mean(scales*evaluations[0], axis = 0), np.mean(scales*evaluations[1], axis = 0)
+    stacked_weights[:, d], objectives = rotosolve_angle(stacked_weights[:, d], objectives, f_plus, f_minus)
+
+  for j in range(n_circuits):
+    weights[j][:] = stacked_weights[j]
+
+  batch_expectations = np.mean(calc_expectations_all(X_batch, weights, n_circuits), axis = 0) if post_expectations else None
+
+  return weights, np.mean(betas), (list(batch_expectations) if post_expectations else None)
@@ -0,0 +1,229 @@
+import json
+import asyncio
+import argparse
+import numpy as np
+import time as timer
+from collections import deque, Counter
+from my_circuit_blueprint import num_feat
+from my_qml import calc_expectations_all, classify_expectations_all
+from my_manager import load_recordings
+
+# --- Protocol ---
+# One json object per line over TCP or a unix socket, every request gets one response line carrying the same 'id'
+# {"id": 7, "features": [x_0, ..., x_n]} -> {"id": 7, "class": c, "expectations": [e_0, ..., e_k]} # Features scaled like the training data
+# {"id": 8, "op": "stats"} -> {"id": 8, "stats": {...}} # Latency percentiles & batch-size histogram
+# A request that can't be served gets {"id": ..., "error": "..."}
+
+class inference_server:
+  def __init__(self, weights, n_circuits, max_batch = 32, max_wait = 0.005, history = 10000):
+    # Serves predictions of fixed weights, requests arriving within max_wait seconds of the first one waiting are run as one batch
+    # of up to max_batch rows through calc_expectations_all, the latencies of the last history requests are kept for the stats
+    self.weights = [np.array(circuit_weights) for circuit_weights in weights]
+    self.n_circuits = n_circuits
+    self.max_batch, self.max_wait = max_batch, max_wait
+    self.pending = deque()
+    self.arrived = None
+    self.latencies = deque(maxlen = history)
+    self.batch_sizes = Counter()
+    self.served = 0
+    self.batch_task = None
+    self.servers = []
+    self.clients = {} # Handler task of every open connection, with its writer
+
+  async def predict(self, features):
+    # Queues one feature vector and waits for its batch, returns the class & the expectation of every circuit
+    features = np.asarray(features, dtype = float)
+    if features.shape != (num_feat,):
+      raise ValueError(f"Expected {num_feat} features, got shape {features.shape}")
+    future = asyncio.get_running_loop().create_future()
+    self.pending.append((features, future, timer.perf_counter()))
+    self.arrived.set()
+    return await future
+
+  async def collect_batch(self):
+    # Waits for a first request, then for more until the batch is full or max_wait has passed since the first one
+    loop = asyncio.get_running_loop()
+    while not self.pending:
+      self.arrived.clear()
+      await self.arrived.wait()
+    deadline = loop.time() + self.max_wait
+    while len(self.pending) < self.max_batch and loop.time() < deadline:
+      self.arrived.clear()
+      try:
+        await asyncio.wait_for(self.arrived.wait(), deadline - loop.time())
+      except asyncio.TimeoutError:
+        break
+    return [self.pending.popleft() for _ in range(min(self.max_batch, len(self.pending)))]
+
+  async def batch_loop(self):
+    # Runs the batches one after the other off the event loop, requests keep queueing up for the next batch meanwhile
+    loop = asyncio.get_running_loop()
+    while True:
+      batch = await self.collect_batch()
+      features = np.array([features for features, _, _ in batch])
+      try:
+        expectations = await loop.run_in_executor(None, calc_expectations_all, features, self.weights, self.n_circuits)
+      except Exception as error:
+        for _, future, _ in batch:
+          future.set_exception(error) if not future.done() else None
+        continue
+      classes = classify_expectations_all(expectations)
+      done_time = timer.perf_counter()
+      self.batch_sizes[len(batch)] += 1
+      for (_, future, arrival_time), classification, row in zip(batch, classes, expectations):
+        self.latencies.append(done_time - arrival_time)
+        self.served += 1
+        future.set_result({'class': int(classification), 'expectations': [float(value) for value in row]}) if not future.done() else None
+
+  def stats(self):
+    # Latency percentiles in milliseconds over the kept requests and how many batches ran at every size
+    latencies = 1000*np.array(self.latencies) if self.latencies else np.zeros(1)
+    batches = sum(self.batch_sizes.values())
+    return {'served': self.served, 'batches': batches, 'mean_batch': self.served/batches if batches else 0.0,
+            'latency_ms': {f"p{q}": float(np.percentile(latencies, q)) for q in [50, 90, 99]} | {'max': float(np.max(latencies))},
+            'batch_histogram': dict(sorted(self.batch_sizes.items()))}
+
+  def reset_stats(self):
+    self.latencies.clear()
+    self.batch_sizes.clear()
+    self.served = 0
+
+  async def respond(self, request, writer, write_lock):
+    # Serves one request line and writes its response line
+    message = {}
+    try:
+      message = json.loads(request)
+      if message.get('op') == 'stats':
+        response = {'stats': self.stats()}
+      else:
+        response = await self.predict(message['features'])
+    except Exception as error:
+      response = {'error': f"{type(error).__name__}: {error}"}
+    async with write_lock:
+      writer.write((json.dumps({'id': message.get('id') if isinstance(message, dict) else None, **response}) + "\n").encode())
+      await writer.drain()
+
+  async def handle_client(self, reader, writer):
+    # Requests on a connection may be pipelined, each is served as soon as its batch is done so responses can come back out of order
+    write_lock = asyncio.Lock()
+    tasks = set()
+    self.clients[asyncio.current_task()] = writer
+    try:
+      while request := await reader.readline():
+        task = asyncio.create_task(self.respond(request, writer, write_lock))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+      await asyncio.gather(*tasks)
+    except ConnectionError:
+      pass
+    finally:
+      self.clients.pop(asyncio.current_task(), None)
+      writer.close()
+
+  async def start(self, host = '127.0.0.1', port = 0, path = None):
+    # Starts the batcher and listens on a unix socket at path, or on host & port (0 picks a free port), returns the listening address
+    self.arrived = asyncio.Event()
+    self.batch_task = self.batch_task if self.batch_task else asyncio.create_task(self.batch_loop())
+    if path:
+      server = await asyncio.start_unix_server(self.handle_client, path = path)
+    else:
+      server = await asyncio.start_server(self.handle_client, host = host, port = port)
+    self.servers.append(server)
+    return path if path else server.sockets[0].getsockname()[:2]
+
+  async def stop(self):
+    # Stops listening, closes the open connections once their handlers have nothing left to answer and stops the batcher
+    for server in self.servers:
+      server.close()
+    for writer in list(self.clients.values()):
+      writer.transport.abort() if writer.transport else None
+    await asyncio.gather(*self.clients, return_exceptions = True)
+    for server in self.servers:
+      await server.wait_closed()
+    self.servers = []
+    if self.batch_task:
+      self.batch_task.cancel()
+      self.batch_task = None
+
+
+def server_from_recording(directory, recording_name, **settings):
+  # Builds a server for the weights of a recording saved with quantum_model.save_recordings
+  n_circuits, weights, _, _, _ = load_recordings(directory, recording_name)
+  return inference_server(weights, n_circuits, **settings)
+
+async def open_client(address):
+  # Connects to a server's address, a unix socket path or a (host, port) tuple
+  if isinstance(address, str):
+    return await asyncio.open_unix_connection(address)
+  return await asyncio.open_connection(*address)
+
+async def request_predictions(address, feature_rows, in_flight = 1):
+  # Sends a prediction request for every feature row over one connection with at most in_flight requests awaiting their response,
+  # returns the responses in row order & the client-side latencies
+  reader, writer = await open_client(address)
+  send_times = [0.0]*len(feature_rows)
+  def send(i):
+    send_times[i] = timer.perf_counter()
+    writer.write((json.dumps({'id': i, 'features': [float(x) for x in feature_rows[i]]}) + "\n").encode())
+  for i in range(min(in_flight, len(feature_rows))):
+    send(i)
+  responses, latencies = [None]*len(feature_rows), [0.0]*len(feature_rows)
+  for sent in range(min(in_flight, len(feature_rows)), len(feature_rows) + min(in_flight, len(feature_rows))):
+    await writer.drain()
+    response = json.loads(await reader.readline())
+    responses[response['id']], latencies[response['id']] = response, timer.perf_counter() - send_times[response['id']]
+    send(sent) if sent < len(feature_rows) else None
+  writer.close()
+  await writer.wait_closed()
+  return responses, latencies
+
+async def request_stats(address):
+  reader, writer = await open_client(address)
+  writer.write((json.dumps({'id': 0, 'op': 'stats'}) + "\n").encode())
+  await writer.drain()
+  stats = json.loads(await reader.readline())['stats']
+  writer.close()
+  await writer.wait_closed()
+  return stats
+
+async def run_load_test(server, feature_rows, n_clients = 8, in_flight = 1, path = None):
+  # Starts server locally, sends feature_rows split over n_clients concurrent connections with in_flight requests outstanding on each,
+  # returns the responses & the server's stats along with the client-side latencies and throughput
+  address = await server.start(path = path)
+  try:
+    server.reset_stats()
+    start_time = timer.perf_counter()
+    results = await asyncio.gather(*[request_predictions(address, feature_rows[k::n_clients], in_flight) for k in range(n_clients)])
+    elapsed = timer.perf_counter() - start_time
+    stats = await request_stats(address)
+  finally:
+    await server.stop()
+  responses = [None]*len(feature_rows)
+  for k, (client_responses, _) in enumerate(results):
+    responses[k::n_clients] = client_responses
+  stats['client_latency_ms'] = {f"p{q}": float(np.percentile(1000*np.concatenate([latencies for _, latencies in results]), q)) for q in [50, 90, 99]}
+  stats['requests_per_second'] = len(feature_rows)/elapsed
+  return responses, stats
+
+def load_test(weights, n_circuits, feature_rows, n_clients = 8, in_flight = 1, max_batch = 32, max_wait = 0.005, path = None):
+  # Runs run_load_test on a new event loop, for scripts & notebooks without one
+  server = inference_server(weights, n_circuits, max_batch = max_batch, max_wait = max_wait)
+  return asyncio.run(run_load_test(server, feature_rows, n_clients = n_clients, in_flight = in_flight, path = path))
+
+async def serve(server, host, port, path):
+  address = await server.start(host = host, port = port, path = path)
+  print(f"Serving predictions on {address}, max_batch {server.max_batch}, max_wait {server.max_wait}s")
+  await asyncio.Event().wait()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = "Micro-batching inference server for a saved quantum_model recording")
+  parser.add_argument('directory')
+  parser.add_argument('recording_name')
+  parser.add_argument('--host', default = '127.0.0.1')
+  parser.add_argument('--port', type = int, default = 8765)
+  parser.add_argument('--path', default = None, help = "Unix socket path, overrides host & port")
+  parser.add_argument('--max-batch', type = int, default = 32)
+  parser.add_argument('--max-wait', type = float, default = 0.005)
+  args = parser.parse_args()
+  server = server_from_recording(args.directory, args.recording_name, max_batch = args.max_batch, max_wait = args.max_wait)
+  asyncio.run(serve(server, args.host, args.port, args.path))
@@ -0,0 +1,281 @@
+import numpy as np
+import my_circuit_blueprint
+from my_cache import lru_cache
+from my_circuit_blueprint import qml, layers, num_feat
+
+def blueprint_setting(name, default):
+  # Reads an optional blueprint setting, blueprints saved before the setting existed run with its default
+  return getattr(my_circuit_blueprint, name, default)
+
+backend_name = blueprint_setting('backend_name', 'pennylane')
+diff_method = blueprint_setting('diff_method', 'parameter-shift')
+spsa_schedule = {'perturbation': 0.1, 'perturbation_decay': 0.101, 'gain_decay': 0.602, 'stability': 0, **blueprint_setting('spsa_schedule', {})}
+prefix_cache_size = blueprint_setting('prefix_cache_size', 0)
+parallel_rows = blueprint_setting('parallel_rows', 1000)
+
+def project_output(circuit_output):
+  # Projects sub-circuit outputs, scalars or arrays over a batch, onto the angles the next layer reads
+  return np.pi*(np.asarray(circuit_output, dtype = float) +1)/2
+
+def compile_layers(layers, num_inputs):
+  # Follows the blueprint's layer queue once with slot numbers, giving every sub-circuit its input slice, param slice and output slot
+  steps = []
+  queue_start, queue_end, param_start = 0, num_inputs, 0
+  for layer in layers:
+    for circ_func, num_circ_feats, num_circ_params in layer:
+      feat_slice = slice(queue_start, queue_start + num_circ_feats)
+      param_slice = slice(param_start, param_start + num_circ_params)
+      assert feat_slice.stop <= queue_end # A sub-circuit can only read values already in the queue
+      queue_start, param_start = queue_start + num_circ_feats, param_start + num_circ_params
+      projected = queue_start < queue_end # Outputs are projected unless they are the last value left in the queue
+      steps.append((circ_func, feat_slice, param_slice, queue_end, projected))
+      queue_end += 1
+  return steps, queue_start, queue_end
+
+def apply_plan(features, params, plan):
+  # Runs every step of a compiled plan, features[i] & params[i] may be arrays over a batch
+  steps, final_slot, num_slots = plan
+  features = np.asarray(features, dtype = float)
+  params = np.asarray(params, dtype = float)
+  batch_shape = np.broadcast_shapes(features.shape[1:], params.shape[1:])
+  slot_values = np.empty((num_slots,) + batch_shape)
+  slot_values[:len(features)] = np.reshape(features, features.shape + (1,)*(len(batch_shape) +1 - features.ndim))
+  for circ_func, feat_slice, param_slice, out_slot, projected in steps:
+    circ_output = circ_func(slot_values[feat_slice], params[param_slice])
+    slot_values[out_slot] = project_output(circ_output) if projected else circ_output
+  return slot_values[final_slot]
+
+# The blueprint's layers as one plan of its QNodes, built here so saved blueprints only have to define their layers
+layer_plan = compile_layers(layers, num_feat)
+
+def plan_circuit(features, params):
+  # Main circuit function on the pennylane backend, the blueprint's QNodes run with the batch broadcast through every layer
+  return apply_plan(features, params, layer_plan)
+
+# Gates the built-in engine can run, blueprints using anything else have to stay on the PennyLane backend
+supported_gates = ['RX', 'CZ']
+
+# Statevectors after the feature-only prefix of each sub-circuit, keyed by the sub-circuit and its feature values
+prefix_cache = lru_cache(prefix_cache_size)
+
+def trace_circuit(qnode, num_circ_feat, num_circ_params):
+  # Records the gates of a sub-circuit by running its function on named placeholders instead of values
+  features = [f"features_{i}" for i in range(num_circ_feat)]
+  params = [f"params_{i}" for i in range(num_circ_params)]
+  with qml.tape.QuantumTape() as tape:
+    qnode.func(features, params)
+  return tape.operations, tape.measurements
+
+def angle_source(angle):
+  # Maps a traced gate angle back to where its value comes from, either ('features', i), ('params', i) or ('const', value)
+  if isinstance(angle, str):
+    source, index = angle.rsplit('_', 1)
+    return source, int(index)
+  return 'const', float(angle)
+
+def observable_terms(obs):
+  # Returns the single-wire factors of an observable, tensor products are stored as .operands or .obs depending on the PennyLane version
+  return getattr(obs, 'operands', None) or getattr(obs, 'obs', None) or [obs]
+
+def wire_bits(num_wires):
+  # Returns the value of each wire's bit over the whole (2,)*num_wires statevector tensor
+  return np.indices((2,)*num_wires)
+
+def cz_signs(wire_pairs, num_wires):
+  # Returns the diagonal of a run of CZ gates as one sign tensor, consecutive CZ gates are fused into a single multiply
+  bits = wire_bits(num_wires)
+  signs = np.ones((2,)*num_wires)
+  for wire_a, wire_b in wire_pairs:
+    signs = signs*(1 - 2*(bits[wire_a] & bits[wire_b]))
+  return signs
+
+def z_signs(wires, num_wires):
+  # Returns the diagonal of a PauliZ tensor product over the given wires
+  bits = wire_bits(num_wires)
+  signs = np.ones((2,)*num_wires)
+  for wire in wires:
+    signs = signs*(1 - 2*bits[wire])
+  return signs
+
+def compile_gates(operations, num_wires):
+  # Converts traced operations to ('RX', axis, source, index) and ('CZ', signs) entries, the statevector axis of a wire counts from the end
+  gates, cz_run = [], []
+  for op in operations + [None]:
+    if op is not None and op.name == 'CZ':
+      cz_run.append(op.wires.tolist())
+      continue
+    if cz_run:
+      gates.append(('CZ', cz_signs(cz_run, num_wires)))
+      cz_run = []
+    if op is None:
+      break
+    if op.name not in supported_gates:
+      raise ValueError(f"Gate {op.name} is not supported by the numpy backend, supported gates are {supported_gates}")
+    source, index = angle_source(op.data[0])
+    gates.append(('RX', op.wires.tolist()[0] - num_wires, source, index))
+  return gates
+
+def compile_observable(measurements, num_wires):
+  # Converts the single PauliZ (tensor product) expectation value of a sub-circuit to its sign tensor
+  if len(measurements) != 1:
+    raise ValueError("The numpy backend only supports sub-circuits returning a single expectation value")
+  terms = observable_terms(measurements[0].obs)
+  if any(term.name != 'PauliZ' for term in terms):
+    raise ValueError("The numpy backend only supports PauliZ (tensor product) expectation values")
+  return z_signs(measurements[0].obs.wires.tolist(), num_wires)
+
+def stack_angles(values):
+  # Stacks a list or array of angles so the first axis is the angle index and the trailing axes are the batch
+  if isinstance(values, np.ndarray):
+    return np.asarray(values, dtype = float)
+  return np.array(np.broadcast_arrays(*[np.asarray(value, dtype = float) for value in values]))
+
+def shared_row(features):
+  # Whether every entry of the batch has the same features, apply_plan broadcasts a single row across the batch of its params
+  return features.ndim == 1 or (features.ndim == 2 and features.shape[1] > 0 and bool(np.all(features == features[:, :1])))
+
+def initial_state(batch_shape, num_wires):
+  # Returns |0...0> for every entry of the batch
+  state = np.zeros(batch_shape + (2,)*num_wires, dtype = complex)
+  state[(Ellipsis,) + (0,)*num_wires] = 1
+  return state
+
+def apply_rx(state, axis, angle, num_wires):
+  # RX(t) = cos(t/2) I - i sin(t/2) X, where X on a wire is a flip of that wire's axis
+  angle = np.reshape(angle, np.shape(angle) + (1,)*num_wires)/2
+  return np.cos(angle)*state - 1j*np.sin(angle)*np.flip(state, axis = axis)
+
+
+class numpy_circuit:
+  def __init__(self, qnode, num_circ_feat, num_circ_params, cache_prefix = False):
+    # Compiles a blueprint sub-circuit to a batched statevector program, called the same way as the QNode it replaces
+    operations, measurements = trace_circuit(qnode, num_circ_feat, num_circ_params)
+    used_wires = [wire for op in operations + [measurements[0].obs] for wire in op.wires.tolist()]
+    self.__name__ = qnode.__name__
+    self.num_wires = max(used_wires) + 1
+    self.gates = compile_gates(operations, self.num_wires)
+    self.observable = compile_observable(measurements, self.num_wires)
+    self.wire_axes = tuple(range(-self.num_wires, 0))
+    self.prefix_length = next((k for k, gate in enumerate(self.gates) if gate[0] == 'RX' and gate[2] == 'params'), len(self.gates)) # Gates before the first param only depend on the features
+    self.cache_prefix = cache_prefix and self.prefix_length > 0 and prefix_cache.max_entries > 0
+
+  def gate_angle(self, gate, angles):
+    # Looks up the value of a gate's angle, constant angles are stored in the gate itself
+    source, index = gate[2], gate[3]
+    return index if source == 'const' else angles[source][index]
+
+  def apply_gates(self, state, gates, angles):
+    # Applies a run of compiled gates to the statevector
+    for gate in gates:
+      if gate[0] == 'CZ':
+        state = state*gate[1]
+      else:
+        state = apply_rx(state, gate[1], self.gate_angle(gate, angles), self.num_wires)
+    return state
+
+  def cached_prefix(self, features):
+    # Returns the statevector after the feature-only prefix, running the prefix only when these features are missing from prefix_cache
+    key = (id(self), features.tobytes())
+    state = prefix_cache.get(key)
+    if state is None:
+      state = self.apply_gates(initial_state((), self.num_wires), self.gates[:self.prefix_length], {'features': features})
+      prefix_cache.put(key, state)
+    return state
+
+  def run(self, features, params):
+    # Runs the gates and returns the final statevector, the features & params may carry a trailing batch axis
+    angles = {'features': stack_angles(features), 'params': stack_angles(params)}
+    if self.cache_prefix and shared_row(angles['features']): # One feature row shared by the whole batch, the case repeated across circuits, shifts & epochs
+      state = self.cached_prefix(np.reshape(angles['features'], (len(angles['features']), -1))[:, 0])
+      return self.apply_gates(state, self.gates[self.prefix_length:], angles)
+    batch_shape = np.broadcast_shapes(angles['features'].shape[1:], angles['params'].shape[1:])
+    return self.apply_gates(initial_state(batch_shape, self.num_wires), self.gates, angles)
+
+  def expectation(self, state):
+    # Expectation value of the PauliZ observable for every statevector in the batch
+    return np.sum((state.real**2 + state.imag**2)*self.observable, axis = self.wire_axes)
+
+  def __call__(self, features, params):
+    return self.expectation(self.run(features, params))
+
+  def adjoint(self, features, params):
+    # Returns the expectation value and its derivatives wrt every feature & param from one forward and one backward sweep
+    angles = {'features': stack_angles(features), 'params': stack_angles(params)}
+    state = self.run(angles['features'], angles['params'])
+    batch_shape = state.shape[:state.ndim - self.num_wires]
+    grads = {source: np.zeros(angles[source].shape[:1] + batch_shape) for source in angles}
+    value = self.expectation(state)
+    adjoint_state = self.observable*state
+
+    for gate in reversed(self.gates):
+      if gate[0] == 'CZ':
+        state, adjoint_state = state*gate[1], adjoint_state*gate[1] # CZ is its own inverse
+        continue
+      axis, source, index = gate[1], gate[2], gate[3]
+      if source != 'const':
+        # d<O>/dt = 2 Re <adjoint_state| dRX/dt |state before RX> = Im <adjoint_state| X |state after RX>
+        overlap = np.sum(np.conj(adjoint_state)*np.flip(state, axis = axis), axis = self.wire_axes)
+        grads[source][index] += overlap.imag
+      angle = -self.gate_angle(gate, angles) # Undo the gate on both states to step one gate backwards
+      state = apply_rx(state, axis, angle, self.num_wires)
+      adjoint_state = apply_rx(adjoint_state, axis, angle, self.num_wires)
+
+    return value, grads['features'], grads['params']
+
+
+def compile_plan(plan):
+  # Swaps every sub-circuit in a compiled layer plan for its numpy_circuit, each distinct QNode is only compiled once per role
+  steps, final_slot, num_slots = plan
+  num_inputs = steps[0][3] # The first output slot comes right after the data features
+  compiled, numpy_steps = {}, []
+  for circ_func, feat_slice, param_slice, out_slot, projected in steps:
+    cache_prefix = feat_slice.stop <= num_inputs # Only sub-circuits fed by data features see the same inputs again, deeper inputs move with the params
+    if (circ_func, cache_prefix) not in compiled:
+      compiled[(circ_func, cache_prefix)] = numpy_circuit(circ_func, feat_slice.stop - feat_slice.start, param_slice.stop - param_slice.start, cache_prefix)
+    numpy_steps.append((compiled[(circ_func, cache_prefix)], feat_slice, param_slice, out_slot, projected))
+  return numpy_steps, final_slot, num_slots
+
+# Compiled plans, filled on first use so blueprints with gates the engine can't run still import on the pennylane backend
+compiled_plans = {}
+
+def get_numpy_plan():
+  # Returns the blueprint's layer plan with every sub-circuit compiled to a numpy_circuit
+  if 'layer_plan' not in compiled_plans:
+    compiled_plans['layer_plan'] = compile_plan(layer_plan)
+  return compiled_plans['layer_plan']
+
+def batch_circuit(features, params):
+  # Main circuit function on the numpy backend, features[i] & params[i] are either scalars or arrays over the batch
+  return apply_plan(features, params, get_numpy_plan())
+
+def backpropagate(plan, local_grads, num_params, batch_shape = ()):
+  # Chains the local derivatives of every step in reverse through the plan, returns the gradient of the final slot wrt all params
+  steps, final_slot, num_slots = plan
+  slot_adjoints = np.zeros((num_slots,) + batch_shape)
+  slot_adjoints[final_slot] = 1
+  gradients = np.zeros((num_params,) + batch_shape)
+
+  for (_, feat_slice, param_slice, out_slot, projected), (feat_grads, param_grads) in reversed(list(zip(steps, local_grads))):
+    out_adjoint = slot_adjoints[out_slot]*(np.pi/2 if projected else 1) # project_output scales the circuit output by pi/2
+    gradients[param_slice] += out_adjoint*param_grads
+    if feat_grads is not None:
+      slot_adjoints[feat_slice] += out_adjoint*feat_grads
+
+  return gradients
+
+def adjoint_gradient(features, params):
+  # Gradient of the layered network wrt its params, every sub-circuit is differentiated by its adjoint sweep and the layers are chained in reverse
+  features, params = stack_angles(features), stack_angles(params)
+  numpy_plan = get_numpy_plan()
+  slot_values, local_grads = list(features), []
+
+  for circ_func, feat_slice, param_slice, out_slot, projected in numpy_plan[0]:
+    value, feat_grads, param_grads = circ_func.adjoint(slot_values[feat_slice], params[param_slice])
+    slot_values.append(project_output(value) if projected else value)
+    local_grads.append((feat_grads, param_grads))
+
+  return backpropagate(numpy_plan, local_grads, len(params), np.shape(slot_values[numpy_plan[1]]))
+
+def prefix_cache_stats():
+  # Hit/miss statistics of the feature-prefix statevector cache
+  return prefix_cache.stats()
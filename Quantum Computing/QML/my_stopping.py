@@ -0,0 +1,82 @@
+import numpy as np
+import time as timer
+from collections import deque
+
+# --- Possible Early Stopping Settings, any combination ---
+# 'patience': k # Stop once the monitored metric hasn't improved by min_delta in k test evaluations
+# 'monitor': 'model_accuracy' # Any metric metrics_test produces, e.g. 'weighted avg_f1-score' or 'C_0_recall'
+# 'mode': 'max' # 'max' if higher is better, 'min' otherwise
+# 'min_delta': 0.0 # Smallest change counted as an improvement
+# 'beta_window': n & 'beta_variance': tol # Stop once the variance of the last n beta-values falls below tol, per-sample beta-values keep some
+#   spread between samples once converged, so tol is best read off the beta-value plots or print_stats of an earlier run
+# 'time_budget': seconds # Stop once training has run this long
+# 'restore_best': True # Put back the weights of the best evaluation when training ends
+
+def make_stopper(early_stopping):
+  # Builds an early_stopper from an early_stopping settings dict, None when no criteria are set
+  return early_stopper(**early_stopping) if early_stopping else None
+
+class early_stopper:
+  def __init__(self, patience = None, monitor = 'model_accuracy', mode = 'max', min_delta = 0.0, beta_window = None, beta_variance = None,
+               time_budget = None, restore_best = True):
+    # Tracks the stopping criteria of one training run, each criterion is off while its setting is None
+    if mode not in ['max', 'min']:
+      raise ValueError(f"Unknown early stopping mode {mode}, use 'max' or 'min'")
+    if (beta_window is None) != (beta_variance is None):
+      raise ValueError("The beta criterion needs both beta_window and beta_variance")
+    self.patience, self.monitor, self.mode, self.min_delta = patience, monitor, mode, min_delta
+    self.beta_window, self.beta_variance = beta_window, beta_variance
+    self.time_budget, self.restore_best = time_budget, restore_best
+    self.betas = deque(maxlen = beta_window if beta_window else 1)
+    self.best_value, self.best_step, self.best_weights = None, None, None
+    self.evaluations_since_best = 0
+    self.start_time = timer.time()
+    self.stop_reason = None
+
+  def improved(self, value):
+    # Whether a metric value beats the best one by more than min_delta
+    if self.best_value is None:
+      return True
+    return value > self.best_value + self.min_delta if self.mode == 'max' else value < self.best_value - self.min_delta
+
+  def update_metrics(self, step, metrics, weights):
+    # Takes the test metrics of the weights at a step, keeping a copy of the best weights, and checks the patience criterion
+    if self.monitor not in metrics:
+      raise ValueError(f"Unknown early stopping monitor {self.monitor}, metrics are {[key for key in metrics if key != 'ConfMatrix']}")
+    if self.improved(metrics[self.monitor]):
+      self.best_value, self.best_step = metrics[self.monitor], step
+      self.best_weights = [np.array(circuit_weights) for circuit_weights in weights]
+      self.evaluations_since_best = 0
+    else:
+      self.evaluations_since_best += 1
+    if self.patience is not None and self.evaluations_since_best >= self.patience and self.stop_reason is None:
+      self.stop_reason = f"{self.monitor} didn't improve in {self.patience} evaluations"
+    return self.should_stop()
+
+  def update_beta(self, beta_value):
+    # Takes the beta-value of a step and checks the beta criterion
+    if self.beta_window is None:
+      return self.should_stop()
+    self.betas.append(beta_value)
+    if len(self.betas) == self.beta_window and np.var(self.betas) < self.beta_variance and self.stop_reason is None:
+      self.stop_reason = f"beta variance below {self.beta_variance} over {self.beta_window} steps"
+    return self.should_stop()
+
+  def should_stop(self):
+    # Whether any criterion has been met, the time budget is checked on every call
+    if self.time_budget is not None and timer.time() - self.start_time >= self.time_budget and self.stop_reason is None:
+      self.stop_reason = f"time budget of {self.time_budget}s used"
+    return self.stop_reason is not None
+
+  def restore(self, weights):
+    # Copies the best evaluated weights back into weights in place, when restore_best is set and there was an evaluation
+    if self.restore_best and self.best_weights is not None:
+      for circuit_weights, best_weights in zip(weights, self.best_weights):
+        circuit_weights[:] = best_weights
+    return weights
+
+  def summary(self, last_step):
+    # Why and where training stopped, with the best evaluation the weights were restored to
+    return {'stopped_early': self.stop_reason is not None, 'stop_reason': self.stop_reason if self.stop_reason else 'completed all epochs',
+            'stop_step': last_step, 'best_step': self.best_step, 'best_' + self.monitor: self.best_value,
+            'restored_best': self.restore_best and self.best_weights is not None, 'train_seconds': timer.time() - self.start_time}
@@ -1,10 +1,19 @@
 import numpy as np
 import pandas as pd
 import time as timer
+from itertools import starmap
+from contextlib import nullcontext, closing
 from warnings import simplefilter
+from my_pool import worker_pool, get_active_pool, in_worker
+from my_recorder import train_recorder, stream_policies
+from my_stopping import make_stopper
+from my_checkpoint import make_checkpointer, training_state, restore_training_state, next_position
+from my_rotosolve import rotosolve_step
 from my_circuit_blueprint import num_params
-from my_qml import step_function, calc_expectations
-from my_metrics import metrics_test, print_metrics_test
+from my_simulator import diff_method
+from my_qml import step_function, calc_expectations, calc_expectations_all, warm_worker, stack_weights, batch_value_and_gradient, run_circuit
+from my_qml import gradient_pool, share_array, attach_array, lazy_step_function, flush_lazy, reset_lazy, get_lazy_counts, spsa_state
+from my_metrics import metrics_test, print_metrics_test, print_stop_summary
 
 simplefilter(action="ignore", category=pd.errors.PerformanceWarning)
 
@@ -16,19 +25,250 @@ simplefilter(action="ignore", category=pd.errors.PerformanceWarning)
 # (sum(expectations) - expectations[target])/n_circuits - 1 # Tau
 
 # Detect and 'optimize'/'de-optimize' the appropriate circuits, optimizing the entire classifier
-def optimize_model(features, target, weights, n_circuits, alpha = 0.1):
+# With a beta_tol, de-optimize steps whose size alpha*|beta| is below it are skipped or deferred by lazy_mode (see lazy_step_function)
+# With concurrent_circuits every circuit's gradient is taken in one batched call instead of circuit by circuit
+def optimize_model(features, target, weights, n_circuits, alpha = 0.1, method = diff_method, beta_tol = None, lazy_mode = 'defer',
+                   concurrent_circuits = False):
 
-  weights[target] = step_function(features, weights[target], alpha = alpha) # Preform standard gradient function on circuit associated with target
+  if concurrent_circuits:
+    weights, beta, _ = concurrent_optimize_step(features, target, weights, n_circuits, alpha = alpha, post_expectations = False, method = method)
+    return weights, beta
+
+  weights, beta, _ = fused_optimize_step(features, target, weights, n_circuits, alpha = alpha, post_expectations = False, method = method,
+                                         beta_tol = beta_tol, lazy_mode = lazy_mode)
+
+  return weights, beta
+
+# Optimize step that runs every forward pass once, also returns the expectations after the step when post_expectations
+# The target's post-step expectation comes from the pass beta is computed from, so only the other circuits run again afterwards
+def fused_optimize_step(features, target, weights, n_circuits, alpha = 0.1, post_expectations = True, method = diff_method, beta_tol = None,
+                        lazy_mode = 'defer'):
+
+  weights[target] = step_function(features, weights[target], alpha = alpha, method = method) # Preform standard gradient function on circuit associated with target
   expectations = calc_expectations(features, weights, n_circuits)
   beta = expectations[target]/sum(expectations) - 1 # Classic
   
+  others = [j for j in range(n_circuits) if j != target] # Determine which indices are not the current target
+  for j in others:
+    if beta_tol is None:
+      weights[j] = step_function(features, weights[j], alpha = alpha, beta = beta, method = method) # Preform negative gradient function on other circuits
+    else:
+      weights[j] = lazy_step_function(features, weights[j], j, alpha = alpha, beta = beta, beta_tol = beta_tol, lazy_mode = lazy_mode, method = method)
+
+  if post_expectations and others:
+    other_expectations = calc_expectations(features, [weights[j] for j in others], len(others)) # The target's weights haven't moved since beta
+    for j, expectation in zip(others, other_expectations):
+      expectations[j] = expectation
+
+  return weights, beta, (expectations if post_expectations else None)
+
+# Optimize step with every circuit's gradient taken in one batched call, the target's shift rows run alongside the other circuits'
+# The other circuits' weights don't move in the target step, so their gradients at the pre-step weights are the ones the sequential step takes
+# and the result matches fused_optimize_step for every method but SPSA, whose circuits all take the gain & perturbation of the first of the
+# n_circuits schedule steps the sequential step would use, with their directions drawn together, the schedule still advances by n_circuits
+# The batched call runs in this process, so the gradient pool thread_count starts for the sequential shift rule isn't used
+def concurrent_optimize_step(features, target, weights, n_circuits, alpha = 0.1, post_expectations = True, method = diff_method):
+
+  stacked_weights = stack_weights(weights, n_circuits)
+  values, gradients = batch_value_and_gradient(np.tile(features, (n_circuits, 1)), stacked_weights, method = method)
+  spsa_state['step'] += n_circuits -1 if method == 'spsa' else 0 # One schedule step per circuit gradient, as in the sequential step
+
+  weights[target] += alpha*gradients[target] # 'optimize' the target
+  expectations = list((values +1)/2)
+  expectations[target] = (run_circuit(features, weights[target]) +1)/2 # Beta needs the target's post-step expectation
+  beta = expectations[target]/sum(expectations) - 1 # Classic
+
+  others = [j for j in range(n_circuits) if j != target]
+  for j in others:
+    weights[j] += (alpha*beta)*gradients[j] # 'de-optimize' the rest by beta
+
+  if post_expectations and others:
+    other_expectations = calc_expectations(features, [weights[j] for j in others], len(others))
+    for j, expectation in zip(others, other_expectations):
+      expectations[j] = expectation
+
+  return weights, beta, (expectations if post_expectations else None)
+
+# Mean one-vs-rest update of a batch of samples at the given weights, every sample's gradients are taken in one call, returns the deltas & betas
+# Each sample's beta is the one the sequential step would compute from these weights, so a batch of one matches fused_optimize_step
+def batch_deltas(X_batch, Y_batch, weights, n_circuits, alpha = 0.1, method = diff_method):
+
+  batch_length = len(X_batch)
+  X_batch, Y_batch = np.asarray(X_batch, dtype = float), np.asarray(Y_batch, dtype = int)
+  stacked_weights = stack_weights(weights, n_circuits)
+  samples = np.arange(batch_length)
+
+  # Values & gradients of every (sample, circuit) pair at the batch-start weights
+  values, gradients = batch_value_and_gradient(np.repeat(X_batch, n_circuits, axis = 0), np.tile(stacked_weights, (batch_length, 1)), method = method)
+  expectations = np.reshape((values +1)/2, (batch_length, n_circuits))
+  gradients = np.reshape(gradients, (batch_length, n_circuits, num_params))
+
+  # Beta needs each sample's target expectation after that sample's own target step
+  target_weights = stacked_weights[Y_batch] + alpha*gradients[samples, Y_batch]
+  expectations[samples, Y_batch] = (run_circuit(X_batch, target_weights) +1)/2
+  betas = expectations[samples, Y_batch]/np.sum(expectations, axis = 1) - 1 # Classic
+
+  scales = np.where(np.arange(n_circuits) == Y_batch[:, None], 1.0, betas[:, None]) # 'optimize' the target, 'de-optimize' the rest by beta
+
+  return alpha*np.mean(scales[:, :, None]*gradients, axis = 0), betas
+
+# Mini-batch optimize step, the batch's one-vs-rest updates are taken at the batch-start weights, averaged and applied once
+def batch_optimize_step(X_batch, Y_batch, weights, n_circuits, alpha = 0.1, post_expectations = True, method = diff_method):
+
+  deltas, betas = batch_deltas(X_batch, Y_batch, weights, n_circuits, alpha = alpha, method = method)
   for j in range(n_circuits):
-    if j != target: # Determine which indices are not the current target
-      weights[j] = step_function(features, weights[j], alpha = alpha, beta = beta) # Preform negative gradient function on other circuits
+    weights[j] += deltas[j]
 
-  return weights, beta
+  batch_expectations = np.mean(calc_expectations_all(X_batch, weights, n_circuits), axis = 0) if post_expectations else None
+
+  return weights, np.mean(betas), (list(batch_expectations) if post_expectations else None)
+
+# Optimize on a batch of samples, a batch of one takes the sequential step
+# optimizer 'gradient' steps along alpha-scaled gradients from method, 'rotosolve' solves every parameter for the maximum of the same objective
+# beta_tol & lazy_mode only apply to the sequential step, concurrent_circuits takes a single sample's circuits in one call (batches always are)
+def train_step(X_batch, Y_batch, weights, n_circuits, alpha = 0.1, post_expectations = True, method = diff_method, optimizer = 'gradient',
+               beta_tol = None, lazy_mode = 'defer', concurrent_circuits = False):
+  if optimizer == 'rotosolve':
+    return rotosolve_step(X_batch, Y_batch, weights, n_circuits, post_expectations = post_expectations)
+  if len(X_batch) == 1 and concurrent_circuits:
+    return concurrent_optimize_step(X_batch[0], Y_batch[0], weights, n_circuits, alpha = alpha, post_expectations = post_expectations, method = method)
+  if len(X_batch) == 1:
+    return fused_optimize_step(X_batch[0], Y_batch[0], weights, n_circuits, alpha = alpha, post_expectations = post_expectations, method = method,
+                               beta_tol = beta_tol, lazy_mode = lazy_mode)
+  return batch_optimize_step(X_batch, Y_batch, weights, n_circuits, alpha = alpha, post_expectations = post_expectations, method = method)
+
+# Lazy de-optimization is part of the sequential step, so it needs single samples, the gradient optimizer and a single process
+def check_lazy_settings(beta_tol, lazy_mode, batch_size = 1, optimizer = 'gradient', n_workers = 1, concurrent_circuits = False):
+  if beta_tol is None:
+    return
+  if lazy_mode not in ['defer', 'skip']:
+    raise ValueError(f"Unknown lazy_mode {lazy_mode}, use 'defer' or 'skip'")
+  if batch_size > 1 or optimizer != 'gradient' or n_workers > 1 or concurrent_circuits:
+    raise ValueError("beta_tol applies to the sequential gradient step, use batch_size = 1, optimizer = 'gradient', n_workers = 1 "
+                     "and concurrent_circuits = False")
+
+# Start & stop of every batch over n_samples samples, the last batch takes what remains
+def batch_bounds(n_samples, batch_size = 1):
+  starts = list(range(0, n_samples, batch_size))
+  return list(zip(starts, starts[1:] + [n_samples]))
 
-# The three functions below are for storing values in large arrays, will later be recoded to save in a file (json or simple array txt)
+# The summed update of rows start:stop of the training set, returned with the number of samples it covers
+# schedule is the caller's SPSA state, every shard of a step takes its gradients at the same schedule step
+def shard_deltas_local(X_train, Y_train, start, stop, weights, schedule, n_circuits, alpha = 0.1, method = diff_method):
+  spsa_state.update(schedule)
+  deltas, _ = batch_deltas(X_train[start:stop], Y_train[start:stop], weights, n_circuits, alpha = alpha, method = method)
+  return (stop - start)*deltas, stop - start
+
+# Worker task, shard_deltas_local on the training set in shared memory
+def shard_deltas(names, shapes, start, stop, weights, schedule, n_circuits, alpha = 0.1, method = diff_method):
+  blocks, (X_train, Y_train) = zip(*[attach_array(name, shape) for name, shape in zip(names, shapes)])
+  result = shard_deltas_local(X_train, Y_train, start, stop, weights, schedule, n_circuits, alpha = alpha, method = method)
+  del X_train, Y_train # Views on the buffers have to go before the blocks can close
+  for block in blocks:
+    block.close()
+  return result
+
+# Synchronous data-parallel epoch, the training set is split into one contiguous shard per worker and every step each worker takes the next
+# batch_size samples of its shard, the updates are all-reduced into their mean over every sample of the step before the weights move
+# A step is the same update batch_optimize_step makes on the union of the workers' batches
+def data_parallel_epoch(X_train, Y_train, weights, n_circuits, alpha = 0.1, batch_size = 1, n_workers = 2, method = diff_method):
+
+  threading_pool = get_active_pool()
+  if threading_pool is None and n_workers > 1 and not in_worker():
+    with gradient_pool(n_workers) as threading_pool: # Outside of a 'with' block a temporary pool is started and shut down around the epoch
+      return data_parallel_epoch(X_train, Y_train, weights, n_circuits, alpha, batch_size, n_workers, method)
+
+  shard_edges = np.linspace(0, len(X_train), n_workers +1).astype(int)
+  shard_batches = [[(shard_start + start, shard_start + stop) for start, stop in batch_bounds(shard_stop - shard_start, batch_size)]
+                   for shard_start, shard_stop in zip(shard_edges[:-1], shard_edges[1:])]
+
+  if threading_pool is None: # Inside a worker the shards are run one after the other, on the arrays themselves
+    shard_step = lambda start, stop, stacked_weights, schedule: shard_deltas_local(X_train, Y_train, start, stop, stacked_weights, schedule,
+                                                                                  n_circuits, alpha, method)
+    run_tasks = lambda input_list: list(starmap(shard_step, input_list))
+    return data_parallel_steps(shard_batches, weights, n_circuits, run_tasks, method)
+
+  arrays = [np.asarray(X_train, dtype = float), np.asarray(Y_train, dtype = float)] # The shards live in shared memory instead of being pickled every step
+  blocks, shared = zip(*[share_array(array) for array in arrays])
+  try:
+    names, shapes = [block.name for block in blocks], [array.shape for array in arrays]
+    run_tasks = lambda input_list: threading_pool.starmap(shard_deltas, [(names, shapes, *task, n_circuits, alpha, method) for task in input_list])
+    weights = data_parallel_steps(shard_batches, weights, n_circuits, run_tasks, method)
+  finally:
+    del shared
+    for block in blocks:
+      block.close()
+      block.unlink()
+
+  return weights
+
+# Runs the synchronous steps of a data-parallel epoch, run_tasks maps (start, stop, weights, schedule) tasks to (summed deltas, count) results
+# The SPSA schedule lives in this process and advances once per step, as batch_optimize_step on the union of the batches would
+def data_parallel_steps(shard_batches, weights, n_circuits, run_tasks, method = diff_method):
+  for k in range(max(len(batches) for batches in shard_batches)):
+    stacked_weights = stack_weights(weights, n_circuits)
+    schedule = dict(spsa_state)
+    summed_deltas, counts = zip(*run_tasks([(*batches[k], stacked_weights, schedule) for batches in shard_batches if k < len(batches)]))
+    spsa_state.update(schedule, step = schedule['step'] + (1 if method == 'spsa' else 0))
+    deltas = np.sum(summed_deltas, axis = 0)/np.sum(counts) # All-reduce
+    for j in range(n_circuits):
+      weights[j] += deltas[j]
+  return weights
+
+# Worker task, runs optimize_model on rows start:stop of the shared training set against the shared weights without any lock
+# Every update is read from & added back to the shared weights as they are at that moment, the version counter counts the updates made so far
+# Returns the staleness of every update, the number of updates other workers made while it was being computed
+# Every update takes its SPSA gradients at the caller's schedule step plus n_circuits per update made so far, the sequential step's schedule
+def hogwild_shard(names, shapes, start, stop, schedule, n_circuits, alpha = 0.1, method = diff_method):
+  blocks, (X_train, Y_train, shared_weights, version) = zip(*[attach_array(name, shape) for name, shape in zip(names, shapes)])
+  staleness = np.zeros(stop - start, dtype = int)
+  for i in range(start, stop):
+    seen_version = version[0]
+    spsa_state.update(schedule, step = schedule['step'] + int(seen_version)*n_circuits)
+    read_weights = np.array(shared_weights) # Lock-free read, rows can come from different updates
+    weights, _ = optimize_model(X_train[i], int(Y_train[i]), [np.array(row) for row in read_weights], n_circuits, alpha = alpha, method = method)
+    staleness[i - start] = version[0] - seen_version
+    shared_weights += stack_weights(weights, n_circuits) - read_weights # Lock-free write of the update, racing writes can still interleave
+    version[0] += 1
+  del X_train, Y_train, shared_weights, version # Views on the buffers have to go before the blocks can close
+  for block in blocks:
+    block.close()
+  return staleness
+
+# Asynchronous (Hogwild-style) epoch, one contiguous shard per worker and every worker updates the weights in shared memory as it goes
+# Returns the weights along with the staleness of every update
+def hogwild_epoch(X_train, Y_train, weights, n_circuits, alpha = 0.1, n_workers = 2, method = diff_method):
+
+  threading_pool = get_active_pool()
+  if threading_pool is None and n_workers > 1 and not in_worker():
+    with gradient_pool(n_workers) as threading_pool: # Outside of a 'with' block a temporary pool is started and shut down around the epoch
+      return hogwild_epoch(X_train, Y_train, weights, n_circuits, alpha, n_workers, method)
+  run_tasks = threading_pool.starmap if threading_pool else lambda func, input_list: list(starmap(func, input_list)) # Shards run in turn inside workers
+
+  shard_edges = np.linspace(0, len(X_train), n_workers +1).astype(int)
+  arrays = [np.asarray(X_train, dtype = float), np.asarray(Y_train, dtype = float), stack_weights(weights, n_circuits), np.zeros(1)]
+  blocks, shared = zip(*[share_array(array) for array in arrays])
+  try:
+    names, shapes = [block.name for block in blocks], [array.shape for array in arrays]
+    schedule = dict(spsa_state) # The SPSA schedule lives in this process, advanced by the epoch's updates once they are done
+    input_list = [(names, shapes, start, stop, schedule, n_circuits, alpha, method) for start, stop in zip(shard_edges[:-1], shard_edges[1:])]
+    staleness = np.concatenate(run_tasks(hogwild_shard, input_list))
+    spsa_state.update(schedule, step = schedule['step'] + (len(X_train)*n_circuits if method == 'spsa' else 0))
+    weights = [np.array(row) for row in shared[2]]
+  finally:
+    del shared
+    for block in blocks:
+      block.close()
+      block.unlink()
+
+  return weights, staleness
+
+# Summarizes the staleness of asynchronous updates
+def staleness_stats(staleness):
+  return {'updates': len(staleness), 'mean': float(np.mean(staleness)), 'median': float(np.median(staleness)),
+          'p95': float(np.percentile(staleness, 95)), 'max': int(np.max(staleness)), 'stale_fraction': float(np.mean(staleness > 0))}
+
+# The functions below turn the classifier's state into rows for the training recorder
 
 # Record the weights of the classifier in an array
 def get_weight_record(weights):
@@ -46,90 +286,271 @@ def get_metric_record(metrics, return_names = False):
     return record, record_names
   return record
 
-def blank_matrix(n_rows, n_cols):
-  return np.zeros([n_rows, n_cols], dtype = float)
+# Quickly train the model without recording values for speed, batch_size samples are averaged into each optimization step
+# With n_workers above 1 every epoch is trained data-parallel, each step takes batch_size samples from each worker's shard
+# early_stopping settings (see my_stopping) end training once a criterion is met, the test set is evaluated once per epoch so patience counts epochs,
+# the beta criterion only applies to single-process training and the steps reported count the training samples seen
+# checkpoint settings (see my_checkpoint) save the training state in the background, after steps of single-process training and after the epochs
+# of parallel training, resume_state continues a run from a loaded checkpoint
+# beta_tol & lazy_mode make de-optimization lazy (see lazy_step_function), deferred steps are all taken by the end of each epoch
+# concurrent_circuits takes every circuit's gradient of a single-sample step in one batched call (see concurrent_optimize_step)
+def quick_train_model(data_tuple, n_circuits, weights, alpha = 0.1, n_epochs = 10, display = True, batch_size = 1, n_workers = 1,
+                      parallel_mode = 'sync', report = None, method = diff_method, optimizer = 'gradient', early_stopping = None, checkpoint = None,
+                      resume_state = None, beta_tol = None, lazy_mode = 'defer', concurrent_circuits = False):
 
-# Quickly train the model without recording values for speed
-def quick_train_model(data_tuple, n_circuits, weights, alpha = 0.1, n_epochs = 10, display = True):
+  if parallel_mode not in ['sync', 'hogwild']:
+    raise ValueError(f"Unknown parallel_mode {parallel_mode}, use 'sync' or 'hogwild'")
+  if optimizer != 'gradient' and n_workers > 1:
+    raise ValueError(f"The {optimizer} optimizer trains in a single process, use n_workers = 1")
+  check_lazy_settings(beta_tol, lazy_mode, batch_size, optimizer, n_workers, concurrent_circuits)
 
   n = -1
+  row_num = 0
   X_train, X_test, Y_train, Y_test = data_tuple
+  settings = {'alpha': alpha, 'n_epochs': n_epochs, 'batch_size': batch_size, 'n_workers': n_workers, 'parallel_mode': parallel_mode,
+              'method': method, 'optimizer': optimizer, 'early_stopping': early_stopping, 'checkpoint': checkpoint, 'beta_tol': beta_tol,
+              'lazy_mode': lazy_mode, 'concurrent_circuits': concurrent_circuits}
+  batches = batch_bounds(len(X_train), batch_size)
+  reset_lazy()
+
+  staleness = []
+  stopper = make_stopper(early_stopping)
+  first_epoch, first_batch = 0, 0
+  if resume_state:
+    weights, stopper = restore_training_state(resume_state, weights)
+    first_epoch, first_batch, row_num, staleness = resume_state['epoch'], resume_state['batch'], resume_state['row_num'], resume_state['staleness']
+    n = first_epoch -1
+  checkpointer = make_checkpointer(checkpoint)
+  save_state = lambda position: checkpointer.submit(training_state('quick_fit', settings, weights, position, row_num, stopper = stopper,
+                                                                   staleness = staleness))
 
   # Train for several epochs, each epoch is going through the training data set once
   start_time = timer.time()
-  for n in range(n_epochs):
-    metrics = metrics_test(weights, X_test, Y_test, n_circuits)
-    print_metrics_test(n, metrics, time_diff = timer.time() - start_time) if display else None # Printing is optional
-
-    start_time = timer.time()
-    # Iterate through the training data set
-    for i in range(len(X_train)):
-      # Optimize the classifier
-      weights, _, = optimize_model(X_train[i], Y_train[i], weights, n_circuits, alpha = alpha)
-      #print("--- %s seconds ---" % (time.time() - start_time))
+  with checkpointer if checkpointer else nullcontext():
+    for n in range(first_epoch, n_epochs):
+      if not (n == first_epoch and first_batch): # A run resumed mid-epoch was already evaluated at the start of the epoch
+        metrics = metrics_test(weights, X_test, Y_test, n_circuits)
+        print_metrics_test(n, metrics, time_diff = timer.time() - start_time) if display else None # Printing is optional
+        if stopper and stopper.update_metrics(row_num, metrics, weights):
+          break
+
+      start_time = timer.time()
+      if n_workers > 1 and parallel_mode == 'hogwild':
+        weights, epoch_staleness = hogwild_epoch(X_train, Y_train, weights, n_circuits, alpha = alpha, n_workers = n_workers, method = method)
+        staleness.append(epoch_staleness)
+        row_num = row_num + len(X_train)
+        save_state((n +1, 0)) if checkpointer else None
+        continue
+      if n_workers > 1:
+        weights = data_parallel_epoch(X_train, Y_train, weights, n_circuits, alpha = alpha, batch_size = batch_size, n_workers = n_workers, method = method)
+        row_num = row_num + len(X_train)
+        save_state((n +1, 0)) if checkpointer else None
+        continue
+      # Iterate through the training data set
+      for i, (start, stop) in enumerate(batches):
+        if n == first_epoch and i < first_batch: # Steps taken before the checkpoint
+          continue
+        # Optimize the classifier
+        weights, beta_value, _ = train_step(X_train[start:stop], Y_train[start:stop], weights, n_circuits, alpha = alpha, post_expectations = False,
+                                            method = method, optimizer = optimizer, beta_tol = beta_tol, lazy_mode = lazy_mode,
+                                            concurrent_circuits = concurrent_circuits)
+        row_num = row_num + stop - start
+        flush_lazy(weights, alpha = alpha, method = method) if beta_tol is not None and i == len(batches) -1 else None
+        if stopper and stopper.update_beta(beta_value):
+          break
+        save_state(next_position(n, i, len(batches))) if checkpointer and checkpointer.due(n*len(batches) + i +1) else None
+        #print("--- %s seconds ---" % (time.time() - start_time))
+      if stopper and stopper.should_stop():
+        break
   
-  metrics = metrics_test(weights, X_test, Y_test, n_circuits)
-  print_metrics_test(n+1, metrics, time_diff = timer.time() - start_time) if display else None # Printing is optional
+    flush_lazy(weights, alpha = alpha, method = method) # Steps still waiting after an early stop
+    metrics = metrics_test(weights, X_test, Y_test, n_circuits)
+    print_metrics_test(n+1, metrics, time_diff = timer.time() - start_time) if display else None # Printing is optional
+    save_state((n_epochs, 0)) if checkpointer else None # The finished run, resuming it only returns the results
+
+  if staleness:
+    stats = staleness_stats(np.concatenate(staleness))
+    report.update({'staleness': stats}) if report is not None else None
+    print("Staleness of asynchronous updates: ", {key: round(value, 2) for key, value in stats.items()}) if display else None
+
+  if beta_tol is not None:
+    report.update({'lazy_deoptimization': get_lazy_counts()}) if report is not None else None
+    print("Lazy de-optimization gradients: ", get_lazy_counts()) if display else None
+
+  if stopper:
+    stopper.update_metrics(row_num, metrics, weights)
+    weights = stopper.restore(weights)
+    summary = stopper.summary(row_num)
+    report.update({'early_stopping': summary}) if report is not None else None
+    print_stop_summary(summary, stopper.monitor) if display else None
 
   return weights
 
-# Train the classifier by selecting which circuit to 'optimize' and which circuits to 'de-optimize' also records all weights and metrics in arrays
-def train_model(data_tuple, n_circuits, weights, alpha = 0.1, n_epochs = 10, display = True):
+# Decide whether the test set should be evaluated after the current step
+def eval_due(row_num, epoch_end, last_eval_time, eval_every = 1, eval_seconds = None):
+  if eval_seconds is not None:
+    return timer.time() - last_eval_time >= eval_seconds # Time-based cadence
+  if eval_every == 'epoch':
+    return epoch_end
+  return row_num % eval_every == 0 # Every eval_every optimization steps
+
+# Evaluate a snapshot of the weights on the test set, on the background worker when the evaluation pool is running
+# Returns the snapshot with the metrics or their AsyncResult, early stopping keeps the snapshot of the best evaluation
+def submit_evaluation(eval_pool, weights, X_test, Y_test, n_circuits):
+  snapshot = [np.array(circuit_weights) for circuit_weights in weights] # Training keeps stepping the weights in place
+  if eval_pool.pool is None:
+    return snapshot, metrics_test(snapshot, X_test, Y_test, n_circuits)
+  return snapshot, eval_pool.apply_async(metrics_test, (snapshot, X_test, Y_test, n_circuits))
+
+# Record finished evaluations at the step they were taken, in order and as the metrics record policy allows, returns the latest metrics
+def merge_evaluations(pending_evals, recorder, metrics, steps_per_epoch, last_step, wait = False, stopper = None):
+  while pending_evals and (wait or isinstance(pending_evals[0][2], dict) or pending_evals[0][2].ready()):
+    row_num, snapshot, result = pending_evals.pop(0)
+    metrics = result if isinstance(result, dict) else result.get()
+    stopper.update_metrics(row_num, metrics, snapshot) if stopper else None
+    if recorder.record_due("metrics", epoch_end = row_num % steps_per_epoch == 0, final = row_num == last_step):
+      recorder.append("metrics", row_num, get_metric_record(metrics))
+  return metrics
+
+# Train the classifier by selecting which circuit to 'optimize' and which circuits to 'de-optimize' also records all weights and metrics to disk
+# The test set is evaluated every eval_every steps ('epoch' for once per epoch) or every eval_seconds, in a background worker if eval_async
+# The records stream to files in the recorder's record_dir in chunks, so memory use doesn't grow with the number of steps, a temporary record_dir
+# is read into memory and removed at the end unless checkpointing keeps it for resume
+# record_policy sets how densely each stream is recorded, e.g. {'weights': 10, 'expectations': 'epoch', 'beta_values': ('reservoir', 500)}
+# With batch_size above 1 every step (and recorded row) covers a batch, recording the batch's mean beta & expectations
+# early_stopping settings (see my_stopping) end training at the step a criterion is met, patience counts test evaluations and asynchronous
+# evaluations are checked as they finish, the stop step is always evaluated & recorded and report gets the stop summary
+# checkpoint settings (see my_checkpoint) save the training state in the background along with the snapshots still being evaluated,
+# resume_state continues a run from a loaded checkpoint at its next step with the recorder on the checkpoint's record_dir and evaluates them again
+# beta_tol & lazy_mode make de-optimization lazy (see lazy_step_function), deferred steps are all taken at the end of each epoch's last step
+# concurrent_circuits takes every circuit's gradient of a single-sample step in one batched call (see concurrent_optimize_step)
+def train_model(data_tuple, n_circuits, weights, alpha = 0.1, n_epochs = 10, display = True, eval_every = 1, eval_seconds = None, eval_async = False,
+                recorder = None, record_policy = None, batch_size = 1, method = diff_method, optimizer = 'gradient', early_stopping = None, report = None,
+                checkpoint = None, resume_state = None, beta_tol = None, lazy_mode = 'defer', concurrent_circuits = False):
+
+  check_lazy_settings(beta_tol, lazy_mode, batch_size, optimizer, concurrent_circuits = concurrent_circuits)
 
   n = -1
   row_num = 0
-  num_metric_values = 7+3*n_circuits
   X_train, X_test, Y_train, Y_test = data_tuple
+  settings = {'alpha': alpha, 'n_epochs': n_epochs, 'eval_every': eval_every, 'eval_seconds': eval_seconds, 'eval_async': eval_async,
+              'record_policy': record_policy, 'batch_size': batch_size, 'method': method, 'optimizer': optimizer, 'early_stopping': early_stopping,
+              'checkpoint': checkpoint, 'beta_tol': beta_tol, 'lazy_mode': lazy_mode,
+              'concurrent_circuits': concurrent_circuits}
 
   start_time = timer.time()
-  train_data_length = len(X_train)
+  batches = batch_bounds(len(X_train), batch_size)
+  train_data_length = len(batches) # Optimization steps per epoch
   record_length = train_data_length*n_epochs +1
-  metrics = metrics_test(weights, X_test, Y_test, n_circuits)
-  
-  beta_data = blank_matrix(record_length, 1)
-  expect_data = blank_matrix(record_length, n_circuits)
-  metric_data = blank_matrix(record_length, num_metric_values)
-  weight_data = blank_matrix(record_length, n_circuits*num_params)
-  
+  first_epoch, first_batch = 0, 0
+  reset_lazy()
+
+  if resume_state:
+    recorder = recorder if recorder else train_recorder(resume_state['recorder']['record_dir'])
+    weights, stopper = restore_training_state(resume_state, weights, recorder)
+    first_epoch, first_batch, row_num, metrics = resume_state['epoch'], resume_state['batch'], resume_state['row_num'], resume_state['metrics']
+    n = first_epoch -1
+  else:
+    metrics = metrics_test(weights, X_test, Y_test, n_circuits)
+    metric_record, metric_names = get_metric_record(metrics, return_names = True)
+
+    policies = stream_policies(record_policy)
+    recorder = recorder if recorder else train_recorder(keep_files = True if checkpoint else None)
+    recorder.add_stream("weights", [f"C_{i}_w_{j}" for i in range(n_circuits) for j in range(num_params)], policy = policies["weights"])
+    recorder.add_stream("metrics", metric_names, policy = policies["metrics"])
+    recorder.add_stream("expectations", [f"C_{i}_expect" for i in range(n_circuits)], policy = policies["expectations"])
+    recorder.add_stream("beta_values", ["Beta Values"], policy = policies["beta_values"])
+
+    # Record the starting weights and metrics of the classifier, the first row offered to a stream is always due except for reservoir samples
+    for name, values in [("beta_values", [0]), ("expectations", [0]*n_circuits), ("weights", get_weight_record(weights)), ("metrics", metric_record)]:
+      if recorder.record_due(name):
+        recorder.append(name, row_num, values)
 
-  # Record the weights and metrics for the class in array form, this and every other recording can be recoded to write to an external file
-  beta_data[row_num] = 0
-  expect_data[row_num] = [0]*n_circuits
-  weight_data[row_num] = get_weight_record(weights)
-  metric_data[row_num], metric_names = get_metric_record(metrics, return_names = True) 
+    stopper = make_stopper(early_stopping)
+    stopper.update_metrics(row_num, metrics, weights) if stopper else None
 
-  beta_names = ["Beta Values"]
-  expect_names = [f"C_{i}_expect" for i in range(n_circuits)]
-  weight_names = [f"C_{i}_w_{j}" for i in range(n_circuits) for j in range(num_params)]
+  pending_evals = []
+  last_eval_time = timer.time()
+  stopping = False
+  checkpointer = make_checkpointer(checkpoint)
 
   # Train for several epochs, each epoch is going through the training data set once
-  for n in range(n_epochs):
-    
-    print_metrics_test(n, metrics, time_diff = timer.time() - start_time) if display else None # Printing is optional
+  # The evaluation pool is kept out of the active pools (started without 'with'), so gradients keep going to the model's pool
+  eval_pool = worker_pool(1 if eval_async else 0, initializer = warm_worker, min_processes = 1)
+  with closing(eval_pool.start()), checkpointer if checkpointer else nullcontext():
+    for eval_row, snapshot in resume_state['pending_evals'] if resume_state else []: # Evaluations that hadn't finished when the checkpoint was taken
+      pending_evals.append((eval_row, *submit_evaluation(eval_pool, snapshot, X_test, Y_test, n_circuits)))
 
-    start_time = timer.time()
-    # Iterate through the training data set
-    for i in range(train_data_length):
+    for n in range(first_epoch, n_epochs):
+      
+      print_metrics_test(n, metrics, time_diff = timer.time() - start_time) if display else None # Printing is optional
 
-      row_num = row_num +1
+      start_time = timer.time()
+      # Iterate through the training data set
+      for i, (start, stop) in enumerate(batches):
+        if n == first_epoch and i < first_batch: # Steps taken before the checkpoint
+          continue
 
-      # Optimize the classifier
-      weights, beta_value = optimize_model(X_train[i], Y_train[i], weights, n_circuits, alpha = alpha)
-      expectations = calc_expectations(X_train[i], weights, n_circuits = n_circuits)
-      metrics = metrics_test(weights, X_test, Y_test, n_circuits)
+        row_num = row_num +1
 
-      beta_data[row_num] = beta_value
-      expect_data[row_num] = expectations
-      metric_data[row_num] = get_metric_record(metrics)
-      weight_data[row_num] = get_weight_record(weights)
+        # Optimize the classifier, the post-step expectations are only computed when they are recorded
+        epoch_end, final = i == train_data_length -1, row_num == record_length -1
+        record_expectations = recorder.record_due("expectations", epoch_end, final)
+        weights, beta_value, expectations = train_step(X_train[start:stop], Y_train[start:stop], weights, n_circuits, alpha = alpha,
+                                                       post_expectations = record_expectations, method = method, optimizer = optimizer,
+                                                       beta_tol = beta_tol, lazy_mode = lazy_mode, concurrent_circuits = concurrent_circuits)
+        if beta_tol is not None and epoch_end: # Take the deferred steps before the epoch's last step is evaluated & recorded
+          weights = flush_lazy(weights, alpha = alpha, method = method)
+          expectations = list(np.mean(calc_expectations_all(X_train[start:stop], weights, n_circuits), axis = 0)) if record_expectations else None
+        stopping = stopper.update_beta(beta_value) if stopper else False
+
+        evaluate = eval_due(row_num, i == train_data_length -1, last_eval_time, eval_every, eval_seconds) or row_num == record_length -1 or stopping
+        if evaluate:
+          last_eval_time = timer.time()
+          pending_evals.append((row_num, *submit_evaluation(eval_pool, weights, X_test, Y_test, n_circuits)))
+        metrics = merge_evaluations(pending_evals, recorder, metrics, train_data_length, row_num if stopping else record_length -1, stopper = stopper)
+
+        if stopper and stopper.should_stop() and not stopping: # Patience ran out on an evaluation that just finished
+          stopping = True
+          pending_evals.append((row_num, *submit_evaluation(eval_pool, weights, X_test, Y_test, n_circuits))) if not evaluate else None
+        final = final or stopping
+
+        if recorder.record_due("beta_values", epoch_end, final):
+          recorder.append("beta_values", row_num, [beta_value])
+        if record_expectations:
+          recorder.append("expectations", row_num, expectations)
+        if recorder.record_due("weights", epoch_end, final):
+          recorder.append("weights", row_num, get_weight_record(weights))
+
+        if checkpointer and not stopping and checkpointer.due(row_num):
+          pending = [(eval_row, snapshot) for eval_row, snapshot, _ in pending_evals]
+          checkpointer.submit(training_state('fit', settings, weights, next_position(n, i, train_data_length), row_num, metrics, recorder, stopper,
+                                             pending_evals = pending))
+
+        if stopping:
+          break
+      if stopping:
+        break
+
+    metrics = merge_evaluations(pending_evals, recorder, metrics, train_data_length, row_num, wait = True, stopper = stopper)
+    flush_lazy(weights, alpha = alpha, method = method) # Steps still waiting after an early stop
+    if checkpointer: # The finished run, resuming it only returns the results
+      checkpointer.submit(training_state('fit', settings, weights, (n_epochs, 0), row_num, metrics, recorder, stopper))
 
   print_metrics_test(n+1, metrics, time_diff = timer.time() - start_time) if display else None # Printing is optional
 
-  # Convert the records of the weights and metrics to dataframe form for easier study, can be easily commented out
+  if beta_tol is not None:
+    report.update({'lazy_deoptimization': get_lazy_counts()}) if report is not None else None
+    print("Lazy de-optimization gradients: ", get_lazy_counts()) if display else None
+
+  if stopper:
+    weights = stopper.restore(weights)
+    summary = stopper.summary(row_num)
+    report.update({'early_stopping': summary}) if report is not None else None
+    print_stop_summary(summary, stopper.monitor) if display else None
+
+  # Read the records back as dataframes indexed by step, memory-mapped from the recorder's files
 
-  b_df = pd.DataFrame(beta_data, columns = beta_names)
-  e_df = pd.DataFrame(expect_data, columns = expect_names)
-  m_df = pd.DataFrame(metric_data, columns = metric_names)
-  w_df = pd.DataFrame(weight_data, columns = weight_names)
+  w_df, m_df, e_df, b_df = recorder.dataframes()
 
-  return weights, (w_df, m_df, e_df, b_df) # Returns the final 'trained' weights and dataframes
\ No newline at end of file
+  return weights, (w_df, m_df, e_df, b_df) # Returns the final 'trained' weights and dataframes